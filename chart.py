@@ -0,0 +1,257 @@
+"""Compact chart payloads for thermostat readings.
+
+Readings are handled as rows of (timestamp, temperature, humidity,
+set_temperature, key_id, heat_on) tuples, with timestamps in whole seconds. They go out
+to the chart as columns rather than rows. Times are a base epoch, the newest
+reading's, with steps back from one reading to the next. Temperature and
+humidity are integer arrays in tenths, and the set point is run-length
+encoded as [value, count, value, count, ...] since it rarely changes.
+
+Longer histories are served as tiles of averaged readings, see tile_from_rows,
+and a day can be drawn as a small SVG by sparkline_svg.
+"""
+import calendar
+
+# Readings are stored at most every 5 minutes, so this covers a day
+WINDOW_SIZE = 300
+# Seconds per bucket at each tile level, each a multiple of the one before
+TILE_LEVELS = (900, 3600, 43200)
+TILE_POINTS = 256
+# Seconds after a tile's end when its readings can no longer change
+TILE_CLOSE_DELAY = 600
+
+
+def reading_rows(readings):
+  """Convert ThermostatData entities, newest first, to rows."""
+  if not readings:
+    return []
+  newest = readings[0].time
+  base = calendar.timegm(newest.utctimetuple())
+  newest_micro = newest.microsecond
+  rows = []
+  for reading in readings:
+    # Whole seconds back from the newest reading, as if both were truncated to
+    # the second first, which is cheaper than converting every time
+    offset = newest - reading.time
+    offset = offset.days * 86400 + offset.seconds + (offset.microseconds > newest_micro)
+    rows.append((base - offset, reading.temperature, reading.humidity,
+        reading.set_temperature, reading.key.id() if reading.key else None, reading.heat_on))
+  return rows
+
+def encode_rows(rows):
+  """Encode rows, newest first, as a dict of columns."""
+  payload = {'base': None, 'dt': [], 't': [], 'h': [], 's': []}
+  if not rows:
+    return payload
+  prev_ts = payload['base'] = rows[0][0]
+  dts = payload['dt']
+  temps = payload['t']
+  hums = payload['h']
+  set_temps = payload['s']
+  run_value = None
+  for row in rows:
+    dts.append(prev_ts - row[0])
+    prev_ts = row[0]
+    temps.append(row[1])
+    hums.append(row[2])
+    if row[3] == run_value and set_temps:
+      set_temps[-1] += 1
+    else:
+      run_value = row[3]
+      set_temps.extend([run_value, 1])
+  return payload
+
+def decode_rows(payload):
+  """Return (timestamp, temperature, humidity, set_temperature) rows, newest first."""
+  rows = []
+  ts = payload['base']
+  runs = payload['s']
+  run = 0
+  left = 0
+  for dt, temp, hum in zip(payload['dt'], payload['t'], payload['h']):
+    ts -= dt
+    if not left:
+      set_temp, left = runs[run], runs[run + 1]
+      run += 2
+    left -= 1
+    rows.append((ts, temp, hum, set_temp))
+  return rows
+
+def tile_range(level, index):
+  """Return the start and end timestamps of a tile."""
+  span = TILE_LEVELS[level] * TILE_POINTS
+  return index * span, (index + 1) * span
+
+def tile_closed(level, index, now):
+  return tile_range(level, index)[1] + TILE_CLOSE_DELAY <= now
+
+def child_tiles(level, index):
+  """Return the indexes of the tiles a level below that make up a tile."""
+  ratio = TILE_LEVELS[level] // TILE_LEVELS[level - 1]
+  return range(index * ratio, (index + 1) * ratio)
+
+def tile_from_rows(level, index, rows):
+  """Average rows into the buckets of a tile.
+
+  A tile has TILE_POINTS buckets of TILE_LEVELS[level] seconds from its start,
+  with the number of readings in each and their average temperature, humidity
+  and set point, which are None for empty buckets.
+  """
+  start = tile_range(level, index)[0]
+  step = TILE_LEVELS[level]
+  counts = [0] * TILE_POINTS
+  sums = [[0] * TILE_POINTS for _ in range(3)]
+  for row in rows:
+    bucket = (row[0] - start) // step
+    if 0 <= bucket < TILE_POINTS:
+      counts[bucket] += 1
+      for values, value in zip(sums, row[1:4]):
+        values[bucket] += value
+  return _make_tile(level, index, counts, sums)
+
+def tile_from_tiles(level, index, tiles):
+  """Combine the tiles a level below into a tile, weighting by their counts."""
+  start = tile_range(level, index)[0]
+  step = TILE_LEVELS[level]
+  counts = [0] * TILE_POINTS
+  sums = [[0] * TILE_POINTS for _ in range(3)]
+  for tile in tiles:
+    for i, count in enumerate(tile['n']):
+      if not count:
+        continue
+      bucket = (tile['start'] + i * tile['step'] - start) // step
+      counts[bucket] += count
+      for values, name in zip(sums, 'ths'):
+        values[bucket] += tile[name][i] * count
+  return _make_tile(level, index, counts, sums)
+
+def _make_tile(level, index, counts, sums):
+  tile = {'level': level, 'index': index, 'start': tile_range(level, index)[0],
+      'step': TILE_LEVELS[level], 'n': counts}
+  for name, values in zip('ths', sums):
+    tile[name] = [int(round(float(value) / count)) if count else None
+        for value, count in zip(values, counts)]
+  return tile
+
+def sparkline_svg(rows, width, height):
+  """Draw rows, newest first, as an SVG of the day to the newest reading.
+
+  The temperature is a line, the set point a stepped line, and the periods
+  with the heat on are shaded. The temperature keeps one point per pixel.
+  """
+  parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">'
+      % (width, height, width, height)]
+  if rows:
+    end = rows[0][0]
+    start = end - 24 * 3600
+    low = min(min(row[1], row[3]) for row in rows) - 10
+    high = max(max(row[1], row[3]) for row in rows) + 10
+    def x(ts):
+      return max(0, ts - start) * float(width) / (end - start)
+    def y(value):
+      return height - (value - low) * float(height) / (high - low)
+
+    heat = []
+    heat_start = None
+    temps = []
+    column = None
+    # Oldest first, each reading lasts until the next one
+    rows = rows[::-1]
+    set_temp = rows[0][3]
+    set_temps = ['M%.1f %.1f' % (x(rows[0][0]), y(set_temp))]
+    for row in rows:
+      if row[5] and heat_start is None:
+        heat_start = x(row[0])
+      elif not row[5] and heat_start is not None:
+        heat.append('M%.1f 0H%.1fV%dH%.1fZ' % (heat_start, x(row[0]), height, heat_start))
+        heat_start = None
+      px = int(x(row[0]))
+      point = '%.1f %.1f' % (x(row[0]), y(row[1]))
+      if px == column:
+        temps[-1] = point
+      else:
+        temps.append(point)
+        column = px
+      if row[3] != set_temp:
+        set_temp = row[3]
+        set_temps.append('H%.1fV%.1f' % (x(row[0]), y(set_temp)))
+    set_temps.append('H%.1f' % x(end))
+    if heat_start is not None:
+      heat.append('M%.1f 0H%.1fV%dH%.1fZ' % (heat_start, x(end), height, heat_start))
+
+    if heat:
+      parts.append('<path d="%s" fill="#fdd"/>' % ''.join(heat))
+    parts.append('<path d="%s" fill="none" stroke="#2ca02c"/>' % ''.join(set_temps))
+    parts.append('<path d="M%s" fill="none" stroke="#1f77b4" stroke-width="1.5"/>'
+        % 'L'.join(temps))
+  parts.append('</svg>')
+  return ''.join(parts)
+
+
+class ReadingWindow(object):
+  """The newest rows for a thermostat, kept in a fixed size ring buffer.
+
+  Also remembers the heat, hold and set point of the newest reading, and its
+  time in microseconds as a version for ETags and polls, since the newest
+  reading may be older than the rows kept. The version only goes up, even when
+  the same reading changes again.
+  """
+  def __init__(self, size=WINDOW_SIZE):
+    self.rows = [None] * size
+    # Index of the oldest row
+    self.start = 0
+    self.count = 0
+    self.heat = None
+    self.hold = None
+    self.set_temp = None
+    self.updated = None
+
+  @classmethod
+  def from_rows(cls, rows, size=WINDOW_SIZE):
+    """Build a window from rows, newest first."""
+    window = cls(size)
+    rows = rows[:size]
+    window.count = len(rows)
+    window.rows[:window.count] = reversed(rows)
+    return window
+
+  def set_latest(self, heat, hold, set_temp, updated):
+    if self.updated is not None and updated <= self.updated:
+      # A schedule change sets a new set point on the same reading, which
+      # clients still need to fetch
+      updated = self.updated + 1
+    self.heat = heat
+    self.hold = hold
+    self.set_temp = set_temp
+    self.updated = updated
+
+  def upsert(self, row):
+    """Replace the newest row if it's the same reading, otherwise append."""
+    size = len(self.rows)
+    newest = (self.start + self.count - 1) % size
+    if self.count and self.rows[newest][4] == row[4]:
+      self.rows[newest] = row
+    elif self.count < size:
+      self.rows[(self.start + self.count) % size] = row
+      self.count += 1
+    else:
+      # Full, so the new row takes the oldest one's place
+      self.rows[self.start] = row
+      self.start = (self.start + 1) % size
+
+  def trim(self, cutoff):
+    """Drop rows at or before the cutoff timestamp."""
+    size = len(self.rows)
+    while self.count and self.rows[self.start][0] <= cutoff:
+      self.rows[self.start] = None
+      self.start = (self.start + 1) % size
+      self.count -= 1
+
+  def newest(self):
+    if not self.count:
+      return None
+    return self.rows[(self.start + self.count - 1) % len(self.rows)]
+
+  def newest_first(self):
+    size = len(self.rows)
+    return [self.rows[(self.start + i) % size] for i in range(self.count - 1, -1, -1)]
@@ -9,7 +9,9 @@ __author__ = "Gustavo Niemeyer <gustavo@niemeyer.net>"
 __license__ = "PSF License"
 
 import datetime
+import re
 import string
+import threading
 import time
 import sys
 import os
@@ -23,7 +25,11 @@ import relativedelta
 import tz
 
 
-__all__ = ["parse", "parserinfo"]
+__all__ = ["parse", "parserinfo", "parsecache"]
+
+# Shared deltas for moving a default date to a parsed weekday
+WEEKDAY_DELTAS = tuple([relativedelta.relativedelta(weekday=x)
+                        for x in range(7)])
 
 
 # Some pointers:
@@ -144,7 +150,60 @@ class _timelex(object):
     split = classmethod(split)
 
 
+class _retimelex(object):
+    """Tokenizer giving the same tokens as _timelex.
+
+    Instead of stepping through a state machine for every character, the
+    whole string is split with a single regular expression. Words and
+    numbers may be joined by dots, which are split off afterwards by the
+    same rules _timelex uses.
+    """
+
+    _wordchars = '[%s]' % re.escape(_timelex('').wordchars)
+    _token_re = re.compile(r'((?:%s+|[0-9]+)(?:\.+(?:%s+|[0-9]+)?)*)|([ \t\r\n])|.'
+                           % (_wordchars, _wordchars), re.DOTALL)
+    _letter_re = re.compile(_wordchars)
+
+    def split(cls, s):
+        if not isinstance(s, basestring):
+            s = s.read()
+        if isinstance(s, unicode):
+            # Like cStringIO in _timelex, only ASCII unicode is accepted
+            s = s.encode('ascii')
+        s = s.replace('\x00', '')
+        tokens = []
+        end = len(s)
+        letter_search = cls._letter_re.search
+        for match in cls._token_re.finditer(s):
+            token = match.group()
+            if match.lastindex == 2:
+                tokens.append(' ')
+            elif match.lastindex is None or '.' not in token:
+                tokens.append(token)
+            else:
+                # _timelex notes having seen letters only once it reads the
+                # character after a letter, which doesn't happen when a number
+                # ends in a single letter at the end of the string.
+                letter = letter_search(token)
+                seenletters = letter is not None and not (
+                    token[0] in '0123456789' and letter.start() == len(token)-1 and
+                    match.end() == end)
+                if (seenletters or token.count('.') > 1 or
+                    token[-1] == '.'):
+                    l = token.split('.')
+                    tokens.append(l[0])
+                    for tok in l[1:]:
+                        tokens.append('.')
+                        if tok:
+                            tokens.append(tok)
+                else:
+                    tokens.append(token)
+        return tokens
+    split = classmethod(split)
+
+
 class _resultbase(object):
+    __slots__ = ()
 
     def __init__(self):
         for attr in self.__slots__:
@@ -289,8 +348,10 @@ class parserinfo(object):
 
 class parser(object):
 
-    def __init__(self, info=None):
+    def __init__(self, info=None, lexer=None):
         self.info = info or parserinfo()
+        # Any class with a split() classmethod, like _timelex or _retimelex
+        self.lexer = lexer or _timelex
 
     def parse(self, timestr, default=None,
                     ignoretz=False, tzinfos=None,
@@ -301,15 +362,18 @@ class parser(object):
         res = self._parse(timestr, **kwargs)
         if res is None:
             raise ValueError, "unknown string format"
-        repl = {}
-        for attr in ["year", "month", "day", "hour",
-                     "minute", "second", "microsecond"]:
-            value = getattr(res, attr)
-            if value is not None:
-                repl[attr] = value
-        ret = default.replace(**repl)
+        # Positional arguments avoid building a keyword dict on every parse
+        ret = default.replace(
+            default.year if res.year is None else res.year,
+            default.month if res.month is None else res.month,
+            default.day if res.day is None else res.day,
+            default.hour if res.hour is None else res.hour,
+            default.minute if res.minute is None else res.minute,
+            default.second if res.second is None else res.second,
+            default.microsecond if res.microsecond is None
+            else res.microsecond)
         if res.weekday is not None and not res.day:
-            ret = ret+relativedelta.relativedelta(weekday=res.weekday)
+            ret = ret+WEEKDAY_DELTAS[res.weekday]
         if not ignoretz:
             if callable(tzinfos) or tzinfos and res.tzname in tzinfos:
                 if callable(tzinfos):
@@ -346,7 +410,7 @@ class parser(object):
         if yearfirst is None:
             yearfirst = info.yearfirst
         res = self._result()
-        l = _timelex.split(timestr)
+        l = self.lexer.split(timestr)
         try:
 
             # year/month/day list
@@ -697,6 +761,81 @@ def parse(timestr, parserinfo=None, **kwargs):
         return DEFAULTPARSER.parse(timestr, **kwargs)
 
 
+class parsecache(object):
+    """Bounded LRU cache of parse results.
+
+    Use parsecache.parse() in place of parse() to have results remembered,
+    keyed by the string, the default datetime, the identity of tzinfos and
+    any other flags. The cache keeps a reference to tzinfos, so an id can't
+    be reused while its entries are alive. Results are immutable datetimes,
+    so they are shared between callers. The cache is safe to use from
+    several threads.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        # Circular doubly linked list of [prev, next, key, result] links,
+        # most recently used first. Cheaper than OrderedDict on Python 2.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def parse(self, timestr, parserinfo=None, **kwargs):
+        tzinfos = kwargs.get("tzinfos")
+        flags = tuple(sorted((k, v) for k, v in kwargs.items()
+                             if k not in ("default", "tzinfos")))
+        key = (timestr, kwargs.get("default"), id(tzinfos),
+               id(parserinfo), flags)
+        return self.memoize(key, parse, timestr, parserinfo=parserinfo,
+                            **kwargs)
+
+    def memoize(self, key, func, *args, **kwargs):
+        """Return the cached result for key, or call func and cache it."""
+        with self._lock:
+            link = self._entries.get(key)
+            if link is not None:
+                # Move the link to the front of the list
+                prev, next = link[0], link[1]
+                prev[1] = next
+                next[0] = prev
+                root = self._root
+                first = root[1]
+                link[0] = root
+                link[1] = first
+                first[0] = root[1] = link
+                self.hits += 1
+                return link[3][0]
+            self.misses += 1
+        value = func(*args, **kwargs)
+        with self._lock:
+            if key not in self._entries:
+                root = self._root
+                first = root[1]
+                # Hold on to the arguments so ids used in the key stay unique
+                link = [root, first, key, (value, args, kwargs)]
+                first[0] = root[1] = self._entries[key] = link
+                if len(self._entries) > self.maxsize:
+                    last = root[0]
+                    last[0][1] = root
+                    root[0] = last[0]
+                    del self._entries[last[2]]
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._root[:] = [self._root, self._root, None, None]
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "maxsize": self.maxsize}
+
+
 class _tzparser(object):
 
     class _result(_resultbase):
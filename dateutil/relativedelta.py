@@ -40,9 +40,12 @@ class weekday(object):
         else:
             return "%s(%+d)" % (s, self.n)
 
+    def __reduce__(self):
+        return (self.__class__, (self.weekday, self.n))
+
 MO, TU, WE, TH, FR, SA, SU = weekdays = tuple([weekday(x) for x in range(7)])
 
-class relativedelta:
+class relativedelta(object):
     """
 The relativedelta type is based on the specification of the excelent
 work done by M.-A. Lemburg in his mx.DateTime extension. However,
@@ -105,6 +108,10 @@ Here is the behavior of operations with relativedelta:
    the calculated date is already Monday, for example, using
    (0, 1) or (0, -1) won't change the day.
     """
+    __slots__ = ["years", "months", "days", "leapdays",
+                 "hours", "minutes", "seconds", "microseconds",
+                 "year", "month", "day", "weekday",
+                 "hour", "minute", "second", "microsecond", "_has_time"]
 
     def __init__(self, dt1=None, dt2=None,
                  years=0, months=0, days=0, leapdays=0, weeks=0,
@@ -260,20 +267,21 @@ Here is the behavior of operations with relativedelta:
                 month += 12
         day = min(calendar.monthrange(year, month)[1],
                   self.day or other.day)
-        repl = {"year": year, "month": month, "day": day}
-        for attr in ["hour", "minute", "second", "microsecond"]:
-            value = getattr(self, attr)
-            if value is not None:
-                repl[attr] = value
         days = self.days
         if self.leapdays and month > 2 and calendar.isleap(year):
             days += self.leapdays
-        ret = (other.replace(**repl)
-               + datetime.timedelta(days=days,
-                                    hours=self.hours,
-                                    minutes=self.minutes,
-                                    seconds=self.seconds,
-                                    microseconds=self.microseconds))
+        # Positional arguments avoid building keyword dicts on every add
+        if self._has_time:
+            ret = other.replace(year, month, day,
+                other.hour if self.hour is None else self.hour,
+                other.minute if self.minute is None else self.minute,
+                other.second if self.second is None else self.second,
+                other.microsecond if self.microsecond is None
+                else self.microsecond)
+        else:
+            ret = other.replace(year, month, day)
+        ret += datetime.timedelta(days, self.seconds, self.microseconds,
+                                  0, self.minutes, self.hours)
         if self.weekday:
             weekday, nth = self.weekday.weekday, self.weekday.n or 1
             jumpdays = (abs(nth)-1)*7
@@ -412,6 +420,19 @@ Here is the behavior of operations with relativedelta:
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    # Unhashable, as it was when this was a classic class
+    __hash__ = None
+
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name in self.__slots__:
+            setattr(self, name, state[name])
+
     def __div__(self, other):
         return self.__mul__(1/float(other))
 
@@ -7,6 +7,7 @@ datetime module.
 __author__ = "Gustavo Niemeyer <gustavo@niemeyer.net>"
 __license__ = "PSF License"
 
+import bisect
 import datetime
 import struct
 import time
@@ -26,6 +27,8 @@ except (ImportError, OSError):
     tzwin, tzwinlocal = None, None
 
 ZERO = datetime.timedelta(0)
+# Number of years of DST transitions each tzrange keeps around
+TRANSITION_CACHE_SIZE = 8
 EPOCHORDINAL = datetime.datetime.utcfromtimestamp(0).toordinal()
 
 class tzutc(datetime.tzinfo):
@@ -212,10 +215,12 @@ class tzfile(datetime.tzinfo):
         # ``standard'' byte order (the high-order  byte
         # of the value is written first).
 
-        if fileobj.read(4) != "TZif":
-            raise ValueError, "magic not found"
+        # The whole file is read at once and each of the arrays below
+        # is unpacked in a single call.
+        data = fileobj.read()
 
-        fileobj.read(16)
+        if data[:4] != "TZif":
+            raise ValueError, "magic not found"
 
         (
          # The number of UTC/local indicators stored in the file.
@@ -240,7 +245,8 @@ class tzfile(datetime.tzinfo):
          # abbreviation strings" stored in the file.
          charcnt,
 
-        ) = struct.unpack(">6l", fileobj.read(24))
+        ) = struct.unpack_from(">6l", data, 20)
+        pos = 44
 
         # The above header is followed by tzh_timecnt four-byte
         # values  of  type long,  sorted  in ascending order.
@@ -249,11 +255,8 @@ class tzfile(datetime.tzinfo):
         # time(2)) at which the rules for computing local time
         # change.
 
-        if timecnt:
-            self._trans_list = struct.unpack(">%dl" % timecnt,
-                                             fileobj.read(timecnt*4))
-        else:
-            self._trans_list = []
+        self._trans_list = struct.unpack_from(">%dl" % timecnt, data, pos)
+        pos += timecnt*4
 
         # Next come tzh_timecnt one-byte values of type unsigned
         # char; each one tells which of the different types of
@@ -262,11 +265,8 @@ class tzfile(datetime.tzinfo):
         # serve as indices into an array of ttinfo structures that
         # appears next in the file.
         
-        if timecnt:
-            self._trans_idx = struct.unpack(">%dB" % timecnt,
-                                            fileobj.read(timecnt))
-        else:
-            self._trans_idx = []
+        self._trans_idx = struct.unpack_from(">%dB" % timecnt, data, pos)
+        pos += timecnt
         
         # Each ttinfo structure is written as a four-byte value
         # for tt_gmtoff  of  type long,  in  a  standard  byte
@@ -279,12 +279,11 @@ class tzfile(datetime.tzinfo):
         # time zone abbreviation characters that follow the
         # ttinfo structure(s) in the file.
 
-        ttinfo = []
-
-        for i in range(typecnt):
-            ttinfo.append(struct.unpack(">lbb", fileobj.read(6)))
+        ttinfo = struct.unpack_from(">" + "lbb"*typecnt, data, pos)
+        pos += typecnt*6
 
-        abbr = fileobj.read(charcnt)
+        abbr = data[pos:pos+charcnt]
+        pos += charcnt
 
         # Then there are tzh_leapcnt pairs of four-byte
         # values, written in  standard byte  order;  the
@@ -296,9 +295,7 @@ class tzfile(datetime.tzinfo):
         # by time.
 
         # Not used, for now
-        if leapcnt:
-            leap = struct.unpack(">%dl" % (leapcnt*2),
-                                 fileobj.read(leapcnt*8))
+        pos += leapcnt*8
 
         # Then there are tzh_ttisstdcnt standard/wall
         # indicators, each stored as a one-byte value;
@@ -308,9 +305,8 @@ class tzfile(datetime.tzinfo):
         # a time zone file is used in handling POSIX-style
         # time zone environment variables.
 
-        if ttisstdcnt:
-            isstd = struct.unpack(">%db" % ttisstdcnt,
-                                  fileobj.read(ttisstdcnt))
+        isstd = struct.unpack_from(">%db" % ttisstdcnt, data, pos)
+        pos += ttisstdcnt
 
         # Finally, there are tzh_ttisgmtcnt UTC/local
         # indicators, each stored as a one-byte value;
@@ -320,16 +316,14 @@ class tzfile(datetime.tzinfo):
         # is used in handling POSIX-style time zone envi-
         # ronment variables.
 
-        if ttisgmtcnt:
-            isgmt = struct.unpack(">%db" % ttisgmtcnt,
-                                  fileobj.read(ttisgmtcnt))
+        isgmt = struct.unpack_from(">%db" % ttisgmtcnt, data, pos)
 
         # ** Everything has been read **
 
         # Build ttinfo list
         self._ttinfo_list = []
         for i in range(typecnt):
-            gmtoff, isdst, abbrind =  ttinfo[i]
+            gmtoff, isdst, abbrind =  ttinfo[i*3:i*3+3]
             # Round to full-minutes if that's not the case. Python's
             # datetime doesn't accept sub-minute timezones. Check
             # http://python.org/sf/1447945 for some information.
@@ -404,12 +398,9 @@ class tzfile(datetime.tzinfo):
                      + dt.hour * 3600
                      + dt.minute * 60
                      + dt.second)
-        idx = 0
-        for trans in self._trans_list:
-            if timestamp < trans:
-                break
-            idx += 1
-        else:
+        # Number of transitions at or before timestamp
+        idx = bisect.bisect_right(self._trans_list, timestamp)
+        if idx == len(self._trans_list):
             return self._ttinfo_std
         if idx == 0:
             return self._ttinfo_before
@@ -473,6 +464,8 @@ class tzfile(datetime.tzinfo):
         return (self.__class__, (self._filename,))
 
 class tzrange(datetime.tzinfo):
+    __slots__ = ["_transition_cache", "_std_abbr", "_dst_abbr",
+                 "_std_offset", "_dst_offset", "_start_delta", "_end_delta"]
 
     def __init__(self, stdabbr, stdoffset=None,
                  dstabbr=None, dstoffset=None,
@@ -480,6 +473,7 @@ class tzrange(datetime.tzinfo):
         global relativedelta
         if not relativedelta:
             from dateutil import relativedelta
+        self._transition_cache = {}
         self._std_abbr = stdabbr
         self._dst_abbr = dstabbr
         if stdoffset is not None:
@@ -521,12 +515,24 @@ class tzrange(datetime.tzinfo):
         else:
             return self._std_abbr
 
+    def _transitions(self, year):
+        # Applying the relativedeltas is costly, so remember the DST
+        # start and end for the last few years used.
+        try:
+            return self._transition_cache[year]
+        except KeyError:
+            pass
+        yearstart = datetime.datetime(year,1,1)
+        transitions = (yearstart+self._start_delta, yearstart+self._end_delta)
+        if len(self._transition_cache) >= TRANSITION_CACHE_SIZE:
+            self._transition_cache.clear()
+        self._transition_cache[year] = transitions
+        return transitions
+
     def _isdst(self, dt):
         if not self._start_delta:
             return False
-        year = datetime.datetime(dt.year,1,1)
-        start = year+self._start_delta
-        end = year+self._end_delta
+        start, end = self._transitions(dt.year)
         dt = dt.replace(tzinfo=None)
         if start < end:
             return dt >= start and dt < end
@@ -549,10 +555,24 @@ class tzrange(datetime.tzinfo):
     def __repr__(self):
         return "%s(...)" % self.__class__.__name__
 
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get("__slots__", ()):
+                if name != "_transition_cache":
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        self._transition_cache = {}
+        for name, value in state.items():
+            setattr(self, name, value)
+
     __reduce__ = object.__reduce__
 
 class tzstr(tzrange):
-    
+    __slots__ = ["_s"]
+
     def __init__(self, s):
         global parser
         if not parser:
@@ -0,0 +1,60 @@
+"""
+Copyright (c) 2003-2005  Gustavo Niemeyer <gustavo@niemeyer.net>
+
+This module offers extensions to the standard python 2.3+
+datetime module.
+"""
+from dateutil.tz import tzfile
+from StringIO import StringIO
+from tarfile import TarFile
+import threading
+import os
+
+__author__ = "Gustavo Niemeyer <gustavo@niemeyer.net>"
+__license__ = "PSF License"
+
+__all__ = ["gettz", "zonenames"]
+
+ZONEINFOFILE = os.path.join(os.path.dirname(__file__), "zoneinfo.tar.gz")
+
+# Zones are parsed at most once per process and kept for its lifetime,
+# which is fine as there are only a few hundred of them.
+_bundle = None
+_cache = {}
+_lock = threading.Lock()
+
+class tzfile(tzfile):
+    def __reduce__(self):
+        return (gettz, (self._filename,))
+
+def _getbundle():
+    # Decompress the bundle once, so zones can then be read from it
+    # without going through the gzip stream again.
+    global _bundle
+    if _bundle is None:
+        tf = TarFile.open(ZONEINFOFILE)
+        try:
+            _bundle = dict((member.name, tf.extractfile(member).read())
+                           for member in tf.getmembers() if member.isfile())
+        finally:
+            tf.close()
+    return _bundle
+
+def gettz(name):
+    try:
+        return _cache[name]
+    except KeyError:
+        pass
+    with _lock:
+        if name not in _cache:
+            data = _getbundle().get(name)
+            if data is None:
+                return None
+            fileobj = StringIO(data)
+            fileobj.name = name
+            _cache[name] = tzfile(fileobj)
+        return _cache[name]
+
+def zonenames():
+    with _lock:
+        return sorted(_getbundle())
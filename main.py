@@ -1,38 +1,66 @@
-import jinja2
+import chart
+import hashlib
 import json
 import logging
+import metrics
 import os
 import random
+import singleflight
 import string
-import urllib2
+import time
+import urllib
 import webapp2
 from datetime import datetime, timedelta
-from dateutil import parser, tz
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.api import urlfetch
 from google.appengine.api import users
+from google.appengine.datastore import datastore_query
+from google.appengine.datastore import datastore_rpc
 from google.appengine.ext import ndb
-from google.appengine.ext.webapp import template
-
-JINJA_ENV = jinja2.Environment(
-  loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-  extensions=['jinja2.ext.autoescape'],
-  autoescape=True,
-)
-
-# Time zones
-dt_schedule = ',M3.2.0,M11.1.0'
-time_zones = [
-  ('Eastern', 'ET', 'EST+5EDT' + dt_schedule),
-  ('Central', 'CT', 'CST+6CDT' + dt_schedule),
-  ('Mountain', 'MT', 'MST+7MDT' + dt_schedule),
-  ('Arizona', 'AZT', 'MST+7'),
-  ('Pacific', 'PT', 'PST+8PDT' + dt_schedule),
-  ('Alaska', 'AKT', 'AKST+9AKDT' + dt_schedule),
-  ('Hawaii-Aleutian', 'HAT', 'HAST+10HADT' + dt_schedule),
-  ('Hawaii', 'HT', 'HAST+10'),
-]
-tzinfos = dict([(t[1], tz.tzstr(t[2])) for t in time_zones])
-tz_select_array = [{'abbr': t[1], 'name': t[0]} for t in time_zones]
-default_tz = tz_select_array[0]['abbr']
+from overrides import (HOLIDAY, PRIORITIES, TEMPORARY, apply_overrides,
+    change_due, earliest_end, from_timestamp, make_override, preview_transitions, prune,
+    to_timestamp)
+from schedules import (compile_schedule, default_tz, get_compiled_schedule,
+    get_provider, get_schedule, get_time_zone, get_tz_select_array, get_tzinfos,
+    hash_schedule, load_parser, local_to_utc, parse_cache_stats,
+    provider_select_array, utc_to_local)
+
+# Built by get_jinja_env, so the thermostat's own requests don't import jinja2
+_jinja_env = None
+# Shares datastore loads between concurrent requests for the same thermostat
+_flights = singleflight.Group()
+
+# Settings for the periodic schedule refresh job
+REFRESH_BATCH_SIZE = 100
+REFRESH_MAX_PARALLEL = 10
+REFRESH_FETCH_DEADLINE = 10
+EXPIRE_BATCH_SIZE = 100
+MAX_PREVIEW_TRANSITIONS = 50
+# Part of the readings ETag, change it when the payload format changes
+READINGS_VERSION = 'r3'
+# Memcache key and lifetime of each thermostat's cached day of readings
+WINDOW_KEY = 'window:2:%s'
+WINDOW_TIME = 2 * 24 * 3600
+WINDOW_CAS_RETRIES = 3
+# Cache rendered dashboard pages in memcache, keyed by the IdData version
+PAGE_CACHE = True
+PAGE_CACHE_TIME = 3600
+# Seconds a long poll for new readings waits, and between its checks
+POLL_TIMEOUT = 25
+POLL_INTERVAL = 2
+# Tiles of the history, change the version when their format changes
+TILE_VERSION = 't1'
+TILE_KEY = 'tile:%s:%s:%d:%d'
+# Seconds the tile that's still filling is cached
+OPEN_TILE_TIME = 300
+# Sparkline images, cached for each bucket of readings
+SPARKLINE_KEY = 'sparkline:%s:%s:%dx%d'
+SPARKLINE_WIDTH = 240
+SPARKLINE_HEIGHT = 60
+SPARKLINE_MAX_AGE = 300
+# Properties the chart needs, fetched by a projection query
+ROW_PROPERTIES = ('i', 't', 'h', 's', 'e')
 
 class IdData(ndb.Model):
   user_id = ndb.StringProperty('u')
@@ -41,6 +69,14 @@ class IdData(ndb.Model):
   schedule_id = ndb.StringProperty('c')
   timezone = ndb.StringProperty('z')
   schedule = ndb.TextProperty('s')
+  schedule_hash = ndb.StringProperty('x', indexed=False)
+  schedule_source = ndb.StringProperty('p', indexed=False)
+  schedule_data = ndb.TextProperty('l')
+  overrides = ndb.JsonProperty('v')
+  # Earliest end of any override, used to find overrides that need expiring
+  overrides_expire = ndb.DateTimeProperty('w')
+  # Version of the settings, for the cached dashboard pages
+  modified = ndb.DateTimeProperty('m', auto_now=True, indexed=False)
 
   @classmethod
   def get_key(cls, t_id):
@@ -51,6 +87,21 @@ class IdData(ndb.Model):
     key = cls.get_key(t_id)
     return cls.query(ancestor=key).get()
 
+  @classmethod
+  def query_scheduled(cls):
+    # Inequality filter skips entities without a schedule and supports cursors
+    return cls.query(cls.schedule_id > '').order(cls.schedule_id)
+
+  @classmethod
+  def query_expired_overrides(cls, now):
+    # The lower bound skips entities without overrides, which store null
+    return cls.query(cls.overrides_expire > datetime(1970, 1, 1),
+        cls.overrides_expire < now)
+
+  def set_overrides(self, overrides):
+    self.overrides = overrides or None
+    self.overrides_expire = earliest_end(overrides)
+
 class ThermostatData(ndb.Model):
   temperature = ndb.IntegerProperty('t')
   humidity = ndb.IntegerProperty('h')
@@ -75,6 +126,61 @@ class ThermostatData(ndb.Model):
     one_day_ago = datetime.utcnow() - timedelta(hours=24)
     return cls.query(cls.time > one_day_ago, ancestor=key).order(-cls.time)
 
+  @classmethod
+  def fetch_oneday_rows(cls, t_id):
+    """Return chart rows for the last day, newest first."""
+    one_day_ago = datetime.utcnow() - timedelta(hours=24)
+    return cls.fetch_rows(t_id, datastore_query.make_filter('i', '>', one_day_ago))
+
+  @classmethod
+  def fetch_range_rows(cls, t_id, start, end):
+    """Return chart rows from the start up to the end datetime, newest first."""
+    return cls.fetch_rows(t_id, datastore_query.CompositeFilter(
+        datastore_query.CompositeFilter.AND,
+        [datastore_query.make_filter('i', '>=', start), datastore_query.make_filter('i', '<', end)]))
+
+  @classmethod
+  def fetch_rows(cls, t_id, filter_predicate):
+    """Return chart rows, newest first, without loading entities."""
+    query = datastore_query.Query(kind=cls._get_kind(),
+        ancestor=cls.get_key(t_id).reference(),
+        filter_predicate=filter_predicate,
+        order=datastore_query.PropertyOrder('i', datastore_query.PropertyOrder.DESCENDING))
+    options = datastore_query.QueryOptions(projection=ROW_PROPERTIES,
+        batch_size=chart.WINDOW_SIZE)
+    rows = []
+    for batch in query.run(datastore_rpc.Connection(adapter=RowAdapter()), options):
+      rows.extend(batch.results)
+    return rows
+
+  @classmethod
+  def first_time(cls, t_id):
+    """Return the time of the oldest reading, or None."""
+    first = cls.query(ancestor=cls.get_key(t_id)).order(cls.time).get(projection=[cls.time])
+    return first.time if first else None
+
+class ReadingTile(ndb.Model):
+  """A closed tile of averaged readings, which never changes."""
+  data = ndb.JsonProperty('d', compressed=True)
+
+  @classmethod
+  def get_key(cls, t_id, level, index):
+    return ndb.Key('Thermostat', t_id, cls, '%s:%d:%d' % (TILE_VERSION, level, index))
+
+class RowAdapter(ndb.ModelAdapter):
+  """Turns ThermostatData projection results straight into chart rows.
+
+  Projected values come back as they're stored in the index, so the time is
+  an integer of microseconds and no model instance is needed per result.
+  """
+  def pb_to_entity(self, pb):
+    values = {}
+    for prop in pb.property_list():
+      value = prop.value()
+      values[prop.name()] = value.booleanvalue() if value.has_booleanvalue() else value.int64value()
+    return (values['i'] // 1000000, values['t'], values['h'], values['s'],
+        pb.key().path().element_list()[-1].id(), values['e'])
+
 
 class PostData(webapp2.RequestHandler):
   def get(self):
@@ -135,11 +241,16 @@ class PostData(webapp2.RequestHandler):
     if set_temp is None:
       set_temp = last_reading.set_temperature
       # If holding temp, ignore schedule
-      if (not hold and id_data.schedule_id
-            and datetime.utcnow() > id_data.next_temp_change):
-          set_temp, next_temp_change = get_next_event(id_data.schedule)
-          id_data.next_temp_change = next_temp_change
-          id_data.put()
+      if (not hold and id_data.schedule
+            and change_due(id_data.next_temp_change, time_now)):
+          overrides = prune(id_data.overrides, time_now)
+          set_temp, next_temp_change = get_set_point(id_data, set_temp, time_now)
+          # Drop ended overrides now rather than waiting for the cron job
+          if (next_temp_change != id_data.next_temp_change
+              or len(overrides) != len(id_data.overrides or [])):
+            id_data.set_overrides(overrides)
+            id_data.next_temp_change = next_temp_change
+            id_data.put()
     else:
       set_temp = int(set_temp)
 
@@ -163,6 +274,7 @@ class PostData(webapp2.RequestHandler):
           heat_on=heat_on,
       )
       new_data.put()
+      update_window(t_id, new_data)
     else:
       # Average together last 5 minutes worth of readings to reduce data storage
       num_averaged = last_reading.num_averaged
@@ -176,7 +288,7 @@ class PostData(webapp2.RequestHandler):
         heat_on=heat_on,
       )
       last_reading.put()
-
+      update_window(t_id, last_reading)
 
     self.response.write('%s,%s,%s' % (set_temp, int(hold), int(heat_on)))
 
@@ -192,18 +304,30 @@ class Schedule(webapp2.RequestHandler):
   def post(self):
     message = None
     t_id = self.request.get('id')
+    provider = get_provider(self.request.get('source'))
     s_id = self.request.get('scheduleId')
+    s_data = self.request.get('scheduleData')
     # Convert from array index back to time zone abbreviation
-    timezone = tz_select_array[int(self.request.get('tz'))]['abbr']
+    timezone = get_tz_select_array()[int(self.request.get('tz'))]['abbr']
     cur_user = users.get_current_user()
     id_data = IdData.get_id(t_id)
-    if cur_user and id_data.user_id == cur_user.user_id():
-      schedule = get_schedule(s_id, timezone)
+    if provider is None:
+      message = 'Unknown schedule source'
+    elif cur_user and id_data.user_id == cur_user.user_id():
+      if provider.remote:
+        schedule, schedule_hash = get_schedule(provider, s_id, timezone)
+      else:
+        # Local sources are stored with the thermostat and apply right away
+        s_id = None
+        schedule, schedule_hash = get_schedule(provider, t_id, timezone, s_data)
       if schedule:
-        set_temperature, next_temp_change = get_next_event(schedule)
+        id_data.schedule_source = provider.name
         id_data.schedule_id = s_id
+        id_data.schedule_data = None if provider.remote else s_data
         id_data.timezone = timezone
         id_data.schedule = schedule
+        id_data.schedule_hash = schedule_hash
+        set_temperature, next_temp_change = get_set_point(id_data, None, datetime.utcnow())
         id_data.next_temp_change = next_temp_change
         id_data.put()
         # print 'Next change: %s' % next_temp_change
@@ -212,6 +336,7 @@ class Schedule(webapp2.RequestHandler):
         if last_reading and not last_reading.hold:
           last_reading.set_temperature = set_temperature
           last_reading.put()
+          update_window(t_id, last_reading)
           message = 'Successfully updated schedule'
         else:
           # TODO: Create new ThermostatData
@@ -227,157 +352,610 @@ class Schedule(webapp2.RequestHandler):
     return self.redirect(url)
 
 
+class Override(webapp2.RequestHandler):
+  def post(self):
+    message = None
+    t_id = self.request.get('id')
+    cur_user = users.get_current_user()
+    id_data = IdData.get_id(t_id)
+    if not (cur_user and id_data and id_data.user_id == cur_user.user_id()):
+      message = 'Must be logged in to change overrides'
+    elif self.request.get('action') == 'clear':
+      id_data.set_overrides(None)
+      id_data.next_temp_change = datetime.utcnow()
+      id_data.put()
+      message = 'Cleared overrides'
+    else:
+      try:
+        override = self.make_override(id_data)
+      except ValueError as e:
+        logging.warning('Warning: invalid override for %s: %s' % (t_id, e))
+        message = 'Could not process override'
+      else:
+        now = datetime.utcnow()
+        id_data.set_overrides(prune(id_data.overrides, now) + [override])
+        # Have the next post from the thermostat pick up the override
+        override_start = from_timestamp(override['b'])
+        if id_data.next_temp_change is None or override_start < id_data.next_temp_change:
+          id_data.next_temp_change = max(override_start, now)
+        id_data.put()
+        message = 'Added override'
+
+    url = '/?id=' + t_id
+    if message:
+      url += '&msg=' + message
+    return self.redirect(url)
+
+  def make_override(self, id_data):
+    kind = self.request.get('kind')
+    if kind not in PRIORITIES:
+      raise ValueError('unknown kind %s' % kind)
+    set_temp = int(float(self.request.get('temperature')) * 10)
+    local_tz = get_time_zone(id_data.timezone or default_tz)
+
+    # Without a schedule there's no set point to go back to when it ends
+    if not id_data.schedule:
+      raise ValueError('overrides need a schedule')
+    if kind == TEMPORARY:
+      # Hold until the schedule's next change
+      start = datetime.utcnow()
+      end = get_compiled_schedule(id_data.schedule).next_event(start)[1]
+    elif kind == HOLIDAY:
+      day = datetime.strptime(self.request.get('date'), '%Y-%m-%d')
+      start = local_to_utc(day, local_tz)
+      end = local_to_utc(day + timedelta(days=1), local_tz)
+    else:
+      start = local_to_utc(datetime.strptime(self.request.get('start'), '%Y-%m-%dT%H:%M'), local_tz)
+      end = local_to_utc(datetime.strptime(self.request.get('end'), '%Y-%m-%dT%H:%M'), local_tz)
+    return make_override(kind, start, end, set_temp)
+
+
+class Preview(webapp2.RequestHandler):
+  def get(self):
+    t_id = self.request.get('id')
+    id_data = IdData.get_id(t_id)
+    if id_data is None:
+      self.response.write('Error: unknown ID')
+      return
+    try:
+      count = min(int(self.request.get('n', 1)), MAX_PREVIEW_TRANSITIONS)
+    except ValueError:
+      count = 1
+
+    now = datetime.utcnow()
+    compiled = get_compiled_schedule(id_data.schedule) if id_data.schedule else None
+    local_tz = get_time_zone(id_data.timezone or default_tz)
+    overrides = prune(id_data.overrides, now) if compiled else []
+    transitions = preview_transitions(compiled, overrides, now, count)
+    result = {
+      'id': t_id,
+      'tz': id_data.timezone or default_tz,
+      'transitions': [{
+        'utc': str(when),
+        'local': str(utc_to_local(when, local_tz)),
+        'set_temp': set_temp,
+      } for when, set_temp in transitions],
+    }
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.write(json.dumps(result, separators=(',',':')))
+
+
+class ExpireOverrides(webapp2.RequestHandler):
+  def get(self):
+    # Started by cron, so kick off the first batch in the task queue
+    taskqueue.add(url='/tasks/expire_overrides', params={'run': new_run_id()})
+
+  def post(self):
+    now = datetime.utcnow()
+    cursor = ndb.Cursor(urlsafe=self.request.get('cursor') or None)
+    id_datas, next_cursor, more = IdData.query_expired_overrides(now).fetch_page(
+        EXPIRE_BATCH_SIZE, start_cursor=cursor)
+    if more and next_cursor:
+      add_next_batch('expire_overrides', self.request, next_cursor)
+
+    expired = 0
+    for id_data in id_datas:
+      if expire_overrides(id_data.key, now):
+        expired += 1
+    logging.info('Expired overrides for %d of %d thermostats' % (expired, len(id_datas)))
+
+
+class RefreshSchedules(webapp2.RequestHandler):
+  def get(self):
+    # Started by cron, so kick off the first batch in the task queue
+    taskqueue.add(url='/tasks/refresh_schedules', params={'run': new_run_id()})
+
+  def post(self):
+    cursor = ndb.Cursor(urlsafe=self.request.get('cursor') or None)
+    id_datas, next_cursor, more = IdData.query_scheduled().fetch_page(
+        REFRESH_BATCH_SIZE, start_cursor=cursor)
+    # Chain the next batch before doing any work so a failure doesn't stop the walk
+    if more and next_cursor:
+      add_next_batch('refresh_schedules', self.request, next_cursor)
+
+    changes = []
+    for start in range(0, len(id_datas), REFRESH_MAX_PARALLEL):
+      changes.extend(refresh_schedules(id_datas[start:start + REFRESH_MAX_PARALLEL]))
+    # The fetches take a while, so write each change against a fresh copy
+    stored = 0
+    for id_data, schedule_hash, schedule in changes:
+      if store_schedule(id_data.key, id_data.schedule_source, id_data.schedule_id,
+          id_data.schedule_hash, schedule_hash, schedule):
+        stored += 1
+    logging.info('Refreshed %d of %d schedules' % (stored, len(id_datas)))
+
+
+class Warmup(webapp2.RequestHandler):
+  def get(self):
+    # Load everything the first page view or schedule change would otherwise wait for
+    start = time.time()
+    get_jinja_env().get_template('index.html')
+    load_parser()
+    get_tzinfos()
+    get_tz_select_array()
+    logging.info('Warmed up in %d ms' % ((time.time() - start) * 1000))
+
+
+class Readings(webapp2.RequestHandler):
+  def get(self):
+    t_id = self.request.get('id')
+    self.response.headers['Content-Type'] = 'application/json'
+    # Browsers keep the data but check back each time
+    self.response.headers['Cache-Control'] = 'no-cache'
+
+    window = get_window(t_id)
+    if window.updated is None:
+      result = readings_result(t_id, window, [])
+      self.response.write(json.dumps(result, separators=(',',':')))
+      return
+    # The newest reading changes with every post, so it stands for the whole day
+    last_modified = window.updated // 1000000
+    etag = '%s-%d' % (READINGS_VERSION, window.updated)
+    self.response.etag = etag
+    self.response.last_modified = from_timestamp(last_modified)
+    if self.not_modified(etag, last_modified):
+      self.response.status = 304
+      return
+
+    result = readings_result(t_id, window, window.newest_first())
+    self.response.write(json.dumps(result, separators=(',',':')))
+
+  def not_modified(self, etag, last_modified):
+    if self.request.if_none_match:
+      return etag in self.request.if_none_match
+    if_modified_since = self.request.if_modified_since
+    return if_modified_since is not None and to_timestamp(if_modified_since) >= last_modified
+
+
+class ReadingsPoll(webapp2.RequestHandler):
+  """Wait for readings newer than the client's and send just those.
+
+  The runtime buffers responses, so instead of streaming the client polls
+  again after each answer. 'since' is the version the client has and 'k' the
+  key of its newest reading, which may have been averaged with newer posts and
+  then replaces it.
+  """
+  def get(self):
+    t_id = self.request.get('id')
+    since = self.request.get_range('since', default=0)
+    key = self.request.get('k')
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.headers['Cache-Control'] = 'no-cache'
+
+    deadline = time.time() + POLL_TIMEOUT
+    window = get_window(t_id)
+    while window.updated is None or window.updated <= since:
+      if time.time() + POLL_INTERVAL > deadline:
+        # Nothing new, the client polls again
+        self.response.status = 204
+        return
+      time.sleep(POLL_INTERVAL)
+      window = get_window(t_id)
+
+    rows = []
+    replace = False
+    since_seconds = since // 1000000
+    for row in window.newest_first():
+      if str(row[4]) == key:
+        rows.append(row)
+        replace = True
+        break
+      if row[0] <= since_seconds:
+        break
+      rows.append(row)
+    result = readings_result(t_id, window, rows)
+    result['replace'] = replace
+    self.response.write(json.dumps(result, separators=(',',':')))
+
+
+class Tiles(webapp2.RequestHandler):
+  def get(self):
+    t_id = self.request.get('id')
+    level = self.request.get_range('level', min_value=0, max_value=len(chart.TILE_LEVELS) - 1,
+        default=0)
+    index = self.request.get_range('index', min_value=0, default=0)
+    tile = get_tiles(t_id, level, [index])[0]
+    self.response.headers['Content-Type'] = 'application/json'
+    if chart.tile_closed(level, index, to_timestamp(datetime.utcnow())):
+      # The URL has the tile version, so a closed tile never changes
+      self.response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+      self.response.headers['Cache-Control'] = 'public, max-age=%d' % OPEN_TILE_TIME
+    self.response.write(json.dumps(tile, separators=(',',':')))
+
+
+class Sparkline(webapp2.RequestHandler):
+  """A small SVG of the last day, for overviews and low power displays.
+
+  It's drawn once for each bucket of readings, whose key is the version. With
+  the current version as 'v' it never changes and is cached for good, without
+  it browsers check back every few minutes.
+  """
+  def get(self):
+    t_id = self.request.get('id')
+    width = self.request.get_range('w', min_value=20, max_value=1200, default=SPARKLINE_WIDTH)
+    height = self.request.get_range('h', min_value=10, max_value=600, default=SPARKLINE_HEIGHT)
+    window = get_window(t_id)
+    newest = window.newest()
+    version = str(newest[4]) if newest else '0'
+
+    requested = self.request.get('v')
+    if requested and requested != version:
+      self.response.headers['Cache-Control'] = 'no-cache'
+      return self.redirect('/sparkline?' + urllib.urlencode(
+          {'id': t_id, 'w': width, 'h': height, 'v': version}))
+    if requested:
+      self.response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+      self.response.headers['Cache-Control'] = 'public, max-age=%d' % SPARKLINE_MAX_AGE
+      etag = '%s-%dx%d' % (version, width, height)
+      self.response.etag = etag
+      if etag in self.request.if_none_match:
+        self.response.status = 304
+        return
+
+    cache_key = SPARKLINE_KEY % (t_id, version, width, height)
+    svg = memcache.get(cache_key)
+    metrics.count_cache('sparkline', svg is not None)
+    if svg is None:
+      svg = chart.sparkline_svg(window.newest_first(), width, height)
+      memcache.set(cache_key, svg, time=WINDOW_TIME)
+    self.response.headers['Content-Type'] = 'image/svg+xml'
+    self.response.write(svg)
+
+
 class Thermostat(webapp2.RequestHandler):
   def get(self):
+    # Check if ID specified
+    # TODO: ID can only be up to 11 characters long
+    t_id = self.request.get('id')
+    message = self.request.get('msg')
+    cur_user = id_data = None
+    if t_id:
+      # Check if user is signed in
+      cur_user = users.get_current_user()
+      # See if the ID is claimed
+      id_data = _flights.do(('id', t_id), IdData.get_id, t_id)
+      if id_data is None and self.request.get('claim') == 'y':
+        if cur_user is None:
+          return self.redirect(str(users.create_login_url('/?id=' + t_id)))
+        id_data = IdData(
+          parent=IdData.get_key(t_id),
+          user_id = cur_user.user_id(),
+          token = create_token(),
+        )
+        id_data.put()
+        return self.redirect('/?id=' + t_id)
+
+    if cur_user is None:
+      role = 'anonymous'
+    elif id_data and id_data.user_id == cur_user.user_id():
+      role = 'owner'
+    else:
+      role = 'viewer'
+    # Messages come once after a redirect, so those pages aren't worth caching
+    cache_key = None
+    if PAGE_CACHE and not message:
+      cache_key = page_cache_key(t_id, role, id_data)
+      page = memcache.get(cache_key)
+      metrics.count_cache('page', page is not None)
+      if page is not None:
+        self.response.write(page)
+        return
+
     info = {
       'id': None,
       'login': None,
       'claimed': False,
       'owned': False,
-      'message': self.request.get('msg'),
-      'timezones': tz_select_array,
+      'message': message,
+      'timezones': get_tz_select_array(),
+      'sources': provider_select_array,
+      'tiles': {'version': TILE_VERSION, 'steps': chart.TILE_LEVELS, 'points': chart.TILE_POINTS},
     }
-    # Check if ID specified
-    # TODO: ID can only be up to 11 characters long
-    t_id = self.request.get('id')
     if t_id:
       info['id'] = t_id
-      # Check if user is signed in
-      cur_user = users.get_current_user()
       if cur_user is None:
         info['login'] = str(users.create_login_url('/?id=' + t_id))
-      # See if the ID is claimed
-      id_data = IdData.get_id(t_id)
-      if id_data is None:
-        claim_id = self.request.get('claim') == 'y'
-        if claim_id:
-          if cur_user is None:
-            return self.redirect(info['login'])
-          id_data = IdData(
-            parent=IdData.get_key(t_id),
-            user_id = cur_user.user_id(),
-            token = create_token(),
-          )
-          id_data.put()
-          return self.redirect('/?id=' + t_id)
-      else:
+      if id_data is not None:
         info['claimed'] = True
         # See if user owns the ID
-        if cur_user and id_data.user_id == cur_user.user_id():
+        if role == 'owner':
           info['token'] = id_data.token
+          info['scheduleSource'] = id_data.schedule_source or provider_select_array[0]['name']
           info['scheduleId'] = id_data.schedule_id
+          info['scheduleData'] = id_data.schedule_data
           info['tz'] = id_data.timezone or default_tz
-
-        # Reformat readings to put them into the template
-        readings = ThermostatData.query_oneday_readings(t_id)
-        last_reading = None
-        values = []
-        for reading in readings:
-          # The last reading is the first in the list
-          if last_reading is None:
-            last_reading = reading
-          time_str = str(reading.time)
-          values.append((time_str.split('.')[0], reading.temperature, reading.humidity, reading.set_temperature))
-        if last_reading:
-          info['heat'] = last_reading.heat_on
-          info['hold'] = last_reading.hold
-          info['set_temp'] = last_reading.set_temperature
-          info['data'] = values
-
-    template = JINJA_ENV.get_template('index.html')
-    self.response.write(template.render({'info': json.dumps(info, separators=(',',':'))}))
-
-
-def normalize(dt_str, local_today):
-  dt = parser.parse(dt_str, tzinfos=tzinfos, default=local_today).astimezone(tz.tzutc()).replace(tzinfo=None)
-
-  # Normalize each datetime to within one week from now
-  now = datetime.utcnow()
-  oneweek = timedelta(days=7)
-  oneweek_from_now = now + oneweek
-  while dt < now:
-    dt += oneweek
-  while dt > oneweek_from_now:
-    dt -= oneweek
-  return dt
+          local_tz = get_time_zone(info['tz'])
+          info['overrides'] = [{
+            'kind': o['k'],
+            'start': str(utc_to_local(from_timestamp(o['b']), local_tz)),
+            'end': str(utc_to_local(from_timestamp(o['e']), local_tz)),
+            'set_temp': o['s'],
+          } for o in prune(id_data.overrides, datetime.utcnow())]
+
+    template = get_jinja_env().get_template('index.html')
+    page = template.render({'info': json.dumps(info, separators=(',',':'))})
+    if cache_key:
+      memcache.set(cache_key, page, time=page_cache_time(role, id_data))
+    self.response.write(page)
+
+
+def get_jinja_env():
+  global _jinja_env
+  if _jinja_env is None:
+    import jinja2
+    _jinja_env = jinja2.Environment(
+      loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
+      extensions=['jinja2.ext.autoescape'],
+      autoescape=True,
+    )
+  return _jinja_env
+
+def get_set_point(id_data, set_temp, now):
+  # Scheduled set point, with any overrides layered on top. Overrides only
+  # apply with a schedule, which sets the temperature again when they end.
+  if not id_data.schedule:
+    return set_temp, None
+  set_temp, next_temp_change = get_compiled_schedule(id_data.schedule).next_event(now)
+  return apply_overrides(prune(id_data.overrides, now), set_temp, next_temp_change, now)
 
 def add_value_to_average(old_value, new_value, num_averaged):
   return (old_value * num_averaged + new_value) / (num_averaged + 1)
 
+def time_version(time):
+  """Return a datetime as integer microseconds, to version cached data by."""
+  return to_timestamp(time) * 1000000 + time.microsecond
+
+def get_window(t_id):
+  """Return the thermostat's ReadingWindow of the last day, from memcache if it's there."""
+  window = memcache.get(WINDOW_KEY % t_id)
+  if window is None:
+    # Concurrent requests share one load, and so the same window, which is
+    # trimmed before it's shared and read only after
+    return _flights.do(('window', t_id), load_window, t_id)
+  window.trim(to_timestamp(datetime.utcnow()) - 24 * 3600)
+  return window
+
+def readings_result(t_id, window, rows):
+  newest = window.newest()
+  return {
+    'id': t_id,
+    'version': window.updated,
+    'key': newest[4] if newest else None,
+    'heat': window.heat,
+    'hold': window.hold,
+    'set_temp': window.set_temp,
+    'data': chart.encode_rows(rows),
+  }
+
+def load_window(t_id):
+  last_future = ThermostatData.query_readings(t_id).get_async()
+  rows = ThermostatData.fetch_oneday_rows(t_id)
+  last_reading = last_future.get_result()
+  window = chart.ReadingWindow.from_rows(rows)
+  if last_reading is not None:
+    window.set_latest(last_reading.heat_on, last_reading.hold,
+        last_reading.set_temperature, time_version(last_reading.time))
+  # Don't replace a window that a post updated in the meantime
+  memcache.add(WINDOW_KEY % t_id, window, time=WINDOW_TIME)
+  window.trim(to_timestamp(datetime.utcnow()) - 24 * 3600)
+  return window
+
+def get_tiles(t_id, level, indexes):
+  """Return tiles of a level, from memcache, the datastore or the readings.
+
+  Tiles above level 0 are combined from the tiles below them. Closed tiles
+  with readings are kept in the datastore as well, since they never change.
+  """
+  now = to_timestamp(datetime.utcnow())
+  cache_keys = dict((index, TILE_KEY % (TILE_VERSION, t_id, level, index)) for index in indexes)
+  cached = memcache.get_multi(cache_keys.values())
+  tiles = dict((index, cached[key]) for index, key in cache_keys.items() if key in cached)
+
+  closed = [index for index in indexes
+      if index not in tiles and chart.tile_closed(level, index, now)]
+  stored = ndb.get_multi([ReadingTile.get_key(t_id, level, index) for index in closed])
+  found = dict((index, entity.data) for index, entity in zip(closed, stored) if entity)
+  tiles.update(found)
+
+  missing = [index for index in indexes if index not in tiles]
+  built = {}
+  if missing and level == 0:
+    first = ThermostatData.first_time(t_id)
+    first = to_timestamp(first) if first else None
+    for index in missing:
+      start, end = chart.tile_range(level, index)
+      rows = []
+      # Skip the query for tiles before the first reading or in the future
+      if first is not None and first < end and start <= now:
+        rows = ThermostatData.fetch_range_rows(t_id, from_timestamp(start), from_timestamp(end))
+      built[index] = chart.tile_from_rows(level, index, rows)
+  elif missing:
+    children = dict((index, chart.child_tiles(level, index)) for index in missing)
+    all_children = sorted(set(child for child_indexes in children.values()
+        for child in child_indexes))
+    child_tiles = dict(zip(all_children, get_tiles(t_id, level - 1, all_children)))
+    for index in missing:
+      built[index] = chart.tile_from_tiles(level, index,
+          [child_tiles[child] for child in children[index]])
+  tiles.update(built)
+
+  ndb.put_multi([ReadingTile(key=ReadingTile.get_key(t_id, level, index), data=tile)
+      for index, tile in built.items() if chart.tile_closed(level, index, now) and any(tile['n'])])
+  found.update(built)
+  closed_tiles = dict((cache_keys[index], tile) for index, tile in found.items()
+      if chart.tile_closed(level, index, now))
+  open_tiles = dict((cache_keys[index], tile) for index, tile in found.items()
+      if not chart.tile_closed(level, index, now))
+  if closed_tiles:
+    memcache.set_multi(closed_tiles)
+  if open_tiles:
+    memcache.set_multi(open_tiles, time=OPEN_TILE_TIME)
+  return [tiles[index] for index in indexes]
+
+def update_window(t_id, reading):
+  """Add a stored reading to the thermostat's cached window, if it has one."""
+  key = WINDOW_KEY % t_id
+  client = memcache.Client()
+  for _ in range(WINDOW_CAS_RETRIES):
+    window = client.gets(key)
+    if window is None:
+      # Built from the datastore on the next read
+      return
+    window.upsert(chart.reading_rows([reading])[0])
+    window.set_latest(reading.heat_on, reading.hold, reading.set_temperature,
+        time_version(reading.time))
+    window.trim(to_timestamp(reading.time) - 24 * 3600)
+    if client.cas(key, window, time=WINDOW_TIME):
+      return
+  logging.warning('Warning: could not update the readings window for %s' % t_id)
+  client.delete(key)
+
+def page_cache_key(t_id, role, id_data):
+  """Key of the rendered dashboard page, which changes with the app and the settings."""
+  version = time_version(id_data.modified) if id_data and id_data.modified else 0
+  return 'page:%s:%s:%s:%d' % (os.environ.get('CURRENT_VERSION_ID', ''), t_id, role, version)
+
+def page_cache_time(role, id_data):
+  # The owner's page lists the overrides, so drop it when the first one ends
+  if role == 'owner' and id_data.overrides_expire:
+    seconds = int((id_data.overrides_expire - datetime.utcnow()).total_seconds()) + 1
+    return max(1, min(PAGE_CACHE_TIME, seconds))
+  return PAGE_CACHE_TIME
+
 def create_token():
   random.seed()
   return ''.join([random.choice(string.ascii_letters + string.digits) for x in range(8)])
 
-def get_schedule(schedule_id, timezone):
-  url = 'https://spreadsheets.google.com/feeds/list/%s/od6/public/values?alt=json' % schedule_id
+def refresh_schedules(id_datas):
+  """Fetch the schedules for a group of IdData entities in parallel.
+
+  Returns (id_data, schedule_hash, schedule) for each feed that changed, for
+  store_schedule. Feeds that fail to load or parse are left out so a transient
+  error doesn't clear a working schedule.
+  """
+  rpcs = []
+  for id_data in id_datas:
+    provider = get_provider(id_data.schedule_source)
+    if provider is None or not provider.remote:
+      continue
+    rpc = urlfetch.create_rpc(deadline=REFRESH_FETCH_DEADLINE)
+    urlfetch.make_fetch_call(rpc, provider.get_url(id_data.schedule_id))
+    rpcs.append((id_data, provider, rpc))
+
+  changed = []
+  for id_data, provider, rpc in rpcs:
+    try:
+      response = rpc.get_result()
+    except urlfetch.Error:
+      logging.warning('Warning: could not retrieve spreadsheet data for %s'
+          % id_data.schedule_id)
+      continue
+    if response.status_code != 200:
+      logging.warning('Warning: status %s retrieving spreadsheet data for %s'
+          % (response.status_code, id_data.schedule_id))
+      continue
+
+    schedule_hash = hash_schedule(response.content)
+    if schedule_hash == id_data.schedule_hash:
+      continue
+    schedule = compile_schedule(provider, id_data.schedule_id, response.content,
+        id_data.timezone or default_tz)
+    if not schedule:
+      continue
+    changed.append((id_data, schedule_hash, schedule))
+  return changed
+
+def new_run_id():
+  return '%d' % (time.time() * 1000)
+
+def add_next_batch(task, request, next_cursor):
+  """Queue the batch after the one a task queue request is running.
+
+  The next task is named after the run and the current batch's cursor, so
+  when a batch fails and is retried it can't queue the next batch a second
+  time and fork the walk. The next cursor can't be used for the name, it
+  changes on a retry when the batch has changed the query's results.
+  """
+  run = request.get('run') or new_run_id()
+  cursor = request.get('cursor').encode('utf-8')
+  name = '%s-%s-%s' % (task.replace('_', '-'), run, hashlib.md5(cursor).hexdigest())
   try:
-    response = urllib2.urlopen(url)
-    content = response.read()
-  except urllib2.URLError:
-    logging.warning('Warning: could not retrieve spreadsheet data for %s' % schedule_id)
+    taskqueue.add(url='/tasks/%s' % task, name=name,
+        params={'cursor': next_cursor.urlsafe(), 'run': run})
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.info('Next batch of %s already queued' % task)
+
+@ndb.transactional
+def expire_overrides(key, now):
+  """Drop a thermostat's ended overrides, on a fresh copy so no other change is lost."""
+  id_data = key.get()
+  if id_data is None:
     return False
-
-  try:
-    data = json.loads(content)
-  except ValueError:
-    logging.error('Error: invalid JSON format for spreadsheet %s' % schedule_id)
+  overrides = prune(id_data.overrides, now)
+  if len(overrides) == len(id_data.overrides or []):
     return False
-
-  if 'feed' not in data or 'entry' not in data['feed']:
-    logging.warning('Warning: invalid data format for %s' % schedule_id)
+  id_data.set_overrides(overrides)
+  id_data.put()
+  return True
+
+@ndb.transactional
+def store_schedule(key, source, schedule_id, old_hash, schedule_hash, schedule):
+  """Store a refreshed schedule, setting only the schedule fields.
+
+  Skipped if the thermostat's schedule settings changed after it was read,
+  since the refreshed feed may no longer be the one it uses.
+  """
+  id_data = key.get()
+  if (id_data is None or id_data.schedule_source != source
+      or id_data.schedule_id != schedule_id or id_data.schedule_hash != old_hash):
     return False
+  id_data.schedule_hash = schedule_hash
+  if schedule != id_data.schedule:
+    id_data.schedule = schedule
+    # Force the next post from the thermostat to pick up the new set point
+    id_data.next_temp_change = datetime.utcnow()
+  id_data.put()
+  return True
 
-  data_keys = [
-    ('gsx$day', 'day'),
-    ('gsx$time', 'time'),
-    ('gsx$temperature', 'temperature'),
-  ]
-
-  # Process entries in spreadsheet
-  schedule = []
-  for entry in data['feed']['entry']:
-    result = {}
-    for entry_key, result_key in data_keys:
-      if entry_key not in entry or '$t' not in entry[entry_key]:
-        logging.warning('Warning: key not found for %s: %s' % (schedule_id, entry_key))
-        return False
-      result[result_key] = entry[entry_key]['$t']
-
-    day_time = '%s %s %s' % (result['day'], result['time'], timezone)
-    try:
-      # TODO: Ensure valid timezone
-      result['datetime'] = parser.parse(day_time)
-    except ValueError:
-      logging.warning('Warning: invalid time format for %s: %s' % (schedule_id, day_time))
-      return False
-    try:
-      result['temperature'] = int(result['temperature'])
-    except ValueError:
-      logging.warning('Warning: invalid temperature format for %s: %s'
-          % (schedule_id, result['temperature']))
-      return False
-
-    schedule.append({'dt': day_time, 't': result['temperature']})
-
-  return json.dumps(schedule, separators=(',', ':'))
-
-def get_next_event(schedule):
-  schedule = json.loads(schedule)
-  # TODO: This needs some clean up
-  time_zone = tzinfos[schedule[0]['dt'].split(' ')[-1]]
-  midnight = {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0, 'tzinfo': None}
-  local_today = datetime.utcnow().replace(tzinfo=tz.tzutc()).astimezone(time_zone).replace(**midnight)
-  current_schedule = [{
-    'dt': normalize(entry['dt'], local_today),
-    't': entry['t'],
-  } for entry in schedule]
-  current_schedule.sort(key=lambda x:x['dt'])
-  return current_schedule[-1]['t'] * 10, current_schedule[0]['dt']
 
+metrics.register_cache('schedule_parse', parse_cache_stats)
+metrics.register_cache('singleflight', _flights.stats)
 
-app = webapp2.WSGIApplication([
+app = metrics.MetricsMiddleware(webapp2.WSGIApplication([
     ('/post', PostData),
     ('/getheat', GetHeat),
     ('/update', Schedule),
+    ('/override', Override),
+    ('/preview', Preview),
+    ('/readings', Readings),
+    ('/readings/poll', ReadingsPoll),
+    ('/tiles', Tiles),
+    ('/sparkline', Sparkline),
+    ('/tasks/refresh_schedules', RefreshSchedules),
+    ('/tasks/expire_overrides', ExpireOverrides),
+    ('/_ah/warmup', Warmup),
+    ('/metrics', metrics.MetricsHandler),
     ('/', Thermostat),
-], debug=True)
+], debug=True))
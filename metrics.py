@@ -0,0 +1,211 @@
+"""In-process request metrics, exposed in the Prometheus text format.
+
+MetricsMiddleware wraps the WSGI application and times each request by
+handler. An apiproxy hook counts and times the datastore, memcache, urlfetch
+and other API calls made during the request, and the memcache hits and misses.
+Other caches report their hit counts through register_cache.
+
+Everything is kept per instance, from when it started. A summary of the
+changes since the last one is logged every FLUSH_INTERVAL seconds, and
+MetricsHandler serves the current values.
+"""
+import collections
+import json
+import logging
+import os
+import threading
+import time
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+
+PREFIX = 'thermostat_'
+# Seconds between logged summaries
+FLUSH_INTERVAL = 60
+# Histogram bucket upper bounds in seconds
+REQUEST_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+RPC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+HELP = {
+  'requests_total': ('counter', 'Requests handled, by handler and status.'),
+  'request_seconds': ('histogram', 'Wall time of requests, by handler.'),
+  'rpc_calls_total': ('counter', 'API calls, by handler, service and method.'),
+  'rpc_errors_total': ('counter', 'API calls that failed, by handler, service and method.'),
+  'rpc_seconds': ('histogram', 'API call latency, by service.'),
+  'cache_hits_total': ('counter', 'Cache lookups that found a value, by cache.'),
+  'cache_misses_total': ('counter', 'Cache lookups that found nothing, by cache.'),
+  'instance_start_time_seconds': ('gauge', 'When this instance started.'),
+}
+
+START_TIME = time.time()
+
+
+class Registry(object):
+  """Thread safe counters and histograms keyed by name and labels."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.counters = collections.defaultdict(float)
+    # (name, labels) -> [count per bucket..., sum, count]
+    self.histograms = {}
+    self.buckets = {}
+    self.caches = {}
+    self.last_flush = time.time()
+    self.flushed = {}
+
+  def inc(self, name, labels, value=1):
+    with self.lock:
+      self.counters[(name, labels)] += value
+
+  def observe(self, name, labels, value, buckets):
+    with self.lock:
+      values = self.histograms.get((name, labels))
+      if values is None:
+        values = self.histograms[(name, labels)] = [0] * (len(buckets) + 2)
+        self.buckets[name] = buckets
+      for i, bound in enumerate(buckets):
+        if value <= bound:
+          values[i] += 1
+      values[-2] += value
+      values[-1] += 1
+
+  def snapshot(self):
+    """Return the counters, with the registered caches read now, and histograms."""
+    counters = {}
+    for name, stats in self.caches.items():
+      hits, misses = stats()
+      counters[('cache_hits_total', (('cache', name),))] = hits
+      counters[('cache_misses_total', (('cache', name),))] = misses
+    with self.lock:
+      counters.update(self.counters)
+      histograms = dict((key, list(values)) for key, values in self.histograms.items())
+    return counters, histograms
+
+  def maybe_flush(self):
+    now = time.time()
+    if now - self.last_flush < FLUSH_INTERVAL:
+      return
+    self.last_flush = now
+    counters = self.snapshot()[0]
+    changes = {}
+    for key, value in counters.items():
+      delta = value - self.flushed.get(key, 0)
+      if delta:
+        name, labels = key
+        changes[format_series(name, labels)] = delta
+    self.flushed = counters
+    if changes:
+      logging.info('Metrics: %s' % json.dumps(changes, sort_keys=True, separators=(',', ':')))
+
+registry = Registry()
+_local = threading.local()
+
+
+def register_cache(name, stats):
+  """Report an in-process cache, stats returns its (hits, misses) so far."""
+  registry.caches[name] = stats
+
+def count_cache(name, hit):
+  """Count a lookup in a cache that doesn't keep its own stats."""
+  registry.inc('cache_hits_total' if hit else 'cache_misses_total', (('cache', name),))
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+      for key, value in labels)
+
+def format_series(name, labels):
+  return PREFIX + name + format_labels(labels)
+
+def format_bound(bound):
+  return repr(float(bound))
+
+def render():
+  """Return all metrics in the Prometheus text exposition format."""
+  counters, histograms = registry.snapshot()
+  counters[('instance_start_time_seconds',
+      (('instance', os.environ.get('INSTANCE_ID', 'local')),))] = START_TIME
+  series = collections.defaultdict(list)
+  for (name, labels), value in sorted(counters.items()):
+    series[name].append('%s %r' % (format_series(name, labels), float(value)))
+  for (name, labels), values in sorted(histograms.items()):
+    lines = series[name]
+    for bound, count in zip(registry.buckets[name], values):
+      lines.append('%s %d' % (format_series(name + '_bucket', labels + (('le', format_bound(bound)),)),
+          count))
+    lines.append('%s %d' % (format_series(name + '_bucket', labels + (('le', '+Inf'),)), values[-1]))
+    lines.append('%s %r' % (format_series(name + '_sum', labels), float(values[-2])))
+    lines.append('%s %d' % (format_series(name + '_count', labels), values[-1]))
+
+  output = []
+  for name in sorted(series):
+    kind, description = HELP[name]
+    output.append('# HELP %s%s %s' % (PREFIX, name, description))
+    output.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+    output.extend(series[name])
+  return '\n'.join(output) + '\n'
+
+
+def _pre_call(service, call, request, response, rpc):
+  if getattr(_local, 'handler', None) is None:
+    return
+  _local.rpc_starts[id(rpc)] = time.time()
+
+def _post_call(service, call, request, response, rpc, error):
+  handler = getattr(_local, 'handler', None)
+  if handler is None:
+    return
+  start = _local.rpc_starts.pop(id(rpc), None)
+  labels = (('handler', handler), ('service', service), ('method', call))
+  registry.inc('rpc_calls_total', labels)
+  if error is not None:
+    registry.inc('rpc_errors_total', labels)
+  elif service == 'memcache' and call == 'Get':
+    hits = response.item_size()
+    registry.inc('cache_hits_total', (('cache', 'memcache'),), hits)
+    registry.inc('cache_misses_total', (('cache', 'memcache'),), request.key_size() - hits)
+  if start is not None:
+    registry.observe('rpc_seconds', (('service', service),), time.time() - start, RPC_BUCKETS)
+
+def _dispatcher(router, request, response):
+  # Label the request with the handler class before it runs, so its API calls
+  # are counted against it. Unmatched requests raise here as they would anyway.
+  handler = router.match(request)[0].handler
+  _local.handler = getattr(handler, '__name__', str(handler))
+  return router.default_dispatcher(request, response)
+
+
+class MetricsMiddleware(object):
+  """WSGI middleware recording request and API call metrics."""
+  def __init__(self, app):
+    self.app = app
+    app.router.set_dispatcher(_dispatcher)
+    hooks = apiproxy_stub_map.apiproxy
+    hooks.GetPreCallHooks().Append('metrics', _pre_call)
+    hooks.GetPostCallHooks().Append('metrics', _post_call)
+
+  def __call__(self, environ, start_response):
+    # Requests the router doesn't match keep this label
+    _local.handler = 'unmatched'
+    _local.rpc_starts = {}
+    statuses = []
+    def record_status(status, headers, exc_info=None):
+      statuses.append(status)
+      return start_response(status, headers, exc_info)
+
+    start = time.time()
+    try:
+      return self.app(environ, record_status)
+    finally:
+      elapsed = time.time() - start
+      handler = _local.handler
+      _local.handler = None
+      status = statuses[-1].split(' ', 1)[0] if statuses else '500'
+      registry.inc('requests_total', (('handler', handler), ('status', status)))
+      registry.observe('request_seconds', (('handler', handler),), elapsed, REQUEST_BUCKETS)
+      registry.maybe_flush()
+
+
+class MetricsHandler(webapp2.RequestHandler):
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+    self.response.write(render())
@@ -0,0 +1,162 @@
+import bisect
+import calendar
+import heapq
+from datetime import datetime, timedelta
+
+# How far ahead to look for changes when previewing
+PREVIEW_HORIZON = timedelta(days=366)
+
+# Override kinds, with later ones taking precedence when they overlap
+VACATION = 'vacation'
+HOLIDAY = 'holiday'
+TEMPORARY = 'temporary'
+PRIORITIES = {VACATION: 1, HOLIDAY: 2, TEMPORARY: 3}
+
+# Built indexes kept per instance, keyed by the overrides they cover
+INDEX_CACHE_SIZE = 256
+_index_cache = {}
+
+
+def to_timestamp(dt):
+  return calendar.timegm(dt.utctimetuple())
+
+def from_timestamp(ts):
+  return datetime.utcfromtimestamp(ts)
+
+def make_override(kind, start, end, set_temp):
+  """Create an override dict for storing on IdData.
+
+  Start and end are naive UTC datetimes, set_temp is in tenths of a degree.
+  """
+  if kind not in PRIORITIES:
+    raise ValueError('unknown override kind: %s' % kind)
+  if end <= start:
+    raise ValueError('override must end after it starts')
+  return {'k': kind, 'b': to_timestamp(start), 'e': to_timestamp(end), 's': set_temp}
+
+def prune(overrides, now):
+  """Return the overrides that haven't ended yet."""
+  now_ts = to_timestamp(now)
+  return [o for o in overrides or [] if o['e'] > now_ts]
+
+def change_due(next_temp_change, now):
+  """Whether the set point is due to change, None means nothing is scheduled."""
+  return next_temp_change is not None and now > next_temp_change
+
+def earliest_end(overrides):
+  if not overrides:
+    return None
+  return from_timestamp(min(o['e'] for o in overrides))
+
+
+class OverrideIndex(object):
+  """Interval index over a list of possibly overlapping overrides.
+
+  The boundaries of all overrides split time into elementary intervals, and
+  the winning override for each interval is resolved once when the index is
+  built. Looking up the override in effect at an instant is then a binary
+  search over the boundaries.
+  """
+  def __init__(self, overrides):
+    events = {}
+    for order, override in enumerate(overrides or []):
+      events.setdefault(override['b'], []).append(order)
+      events.setdefault(override['e'], [])
+    self.bounds = sorted(events)
+    self.winners = []
+
+    # Sweep over the boundaries keeping the active overrides in a heap
+    active = []
+    for bound in self.bounds:
+      for order in events[bound]:
+        override = overrides[order]
+        heapq.heappush(active, (-PRIORITIES[override['k']], -order, override))
+      # Drop overrides that have ended, lazily from the top of the heap
+      while active and active[0][2]['e'] <= bound:
+        heapq.heappop(active)
+      self.winners.append(active[0][2] if active else None)
+
+  def lookup(self, ts):
+    idx = bisect.bisect_right(self.bounds, ts) - 1
+    if idx < 0:
+      return None
+    return self.winners[idx]
+
+  def next_boundary(self, ts):
+    idx = bisect.bisect_right(self.bounds, ts)
+    if idx >= len(self.bounds):
+      return None
+    return self.bounds[idx]
+
+
+def get_override_index(overrides):
+  """Return the OverrideIndex for overrides, building it only once per instance."""
+  key = tuple((o['k'], o['b'], o['e'], o['s']) for o in overrides or [])
+  index = _index_cache.get(key)
+  if index is None:
+    if len(_index_cache) >= INDEX_CACHE_SIZE:
+      _index_cache.clear()
+    index = _index_cache[key] = OverrideIndex(overrides)
+  return index
+
+
+def apply_overrides(overrides, set_temp, next_temp_change, now):
+  """Layer the overrides on top of the scheduled set point.
+
+  Returns the effective set temperature at now and the next time it may change,
+  which is the earlier of the next scheduled change and the next override
+  boundary.
+  """
+  index = get_override_index(overrides)
+  now_ts = to_timestamp(now)
+  override = index.lookup(now_ts)
+  if override:
+    set_temp = override['s']
+  boundary = index.next_boundary(now_ts)
+  if boundary is not None:
+    boundary = from_timestamp(boundary)
+    if next_temp_change is None or boundary < next_temp_change:
+      next_temp_change = boundary
+  return set_temp, next_temp_change
+
+
+def preview_transitions(compiled, overrides, now, count):
+  """Return up to count (utc, set_temp) changes of the effective set point.
+
+  Merges the scheduled transitions of a CompiledSchedule (which may be None)
+  with the override boundaries, skipping changes that don't alter the set point.
+  """
+  index = get_override_index(overrides)
+  scheduled = compiled.transitions(now) if compiled else iter([])
+  sched_temp = compiled.set_point_at(now) if compiled else None
+  next_sched = next(scheduled, None)
+  now_ts = to_timestamp(now)
+  next_bound = index.next_boundary(now_ts)
+
+  def effective(ts):
+    override = index.lookup(ts)
+    return override['s'] if override else sched_temp
+
+  results = []
+  current = effective(now_ts)
+  horizon = now + PREVIEW_HORIZON
+  while len(results) < count:
+    bound_dt = from_timestamp(next_bound) if next_bound is not None else None
+    if next_sched is not None and (bound_dt is None or next_sched[0] <= bound_dt):
+      when = next_sched[0]
+      sched_temp = next_sched[2]
+      next_sched = next(scheduled, None)
+    elif bound_dt is not None:
+      when = bound_dt
+    else:
+      break
+    if when > horizon:
+      break
+    when_ts = to_timestamp(when)
+    if next_bound is not None and when_ts >= next_bound:
+      next_bound = index.next_boundary(when_ts)
+    set_temp = effective(when_ts)
+    if set_temp is not None and set_temp != current:
+      results.append((when, set_temp))
+    current = set_temp
+  return results
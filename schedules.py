@@ -0,0 +1,479 @@
+import csv
+import hashlib
+import json
+import logging
+import re
+import StringIO
+import threading
+from datetime import datetime, timedelta
+from dateutil import tz
+
+# dateutil's parser and zoneinfo bundle are slow to import and aren't needed
+# by most requests, so they're imported on first use
+parser = None
+zoneinfo = None
+
+# Time zones
+dt_schedule = ',M3.2.0,M11.1.0'
+time_zones = [
+  ('Eastern', 'ET', 'EST+5EDT' + dt_schedule),
+  ('Central', 'CT', 'CST+6CDT' + dt_schedule),
+  ('Mountain', 'MT', 'MST+7MDT' + dt_schedule),
+  ('Arizona', 'AZT', 'MST+7'),
+  ('Pacific', 'PT', 'PST+8PDT' + dt_schedule),
+  ('Alaska', 'AKT', 'AKST+9AKDT' + dt_schedule),
+  ('Hawaii-Aleutian', 'HAT', 'HAST+10HADT' + dt_schedule),
+  ('Hawaii', 'HT', 'HAST+10'),
+]
+# Filled in by get_tzinfos, parsing the tzstr strings takes a while
+tzinfos = {}
+tz_select_array = [{'abbr': t[1], 'name': t[0]} for t in time_zones]
+default_tz = tz_select_array[0]['abbr']
+# Filled in with the IANA zones from the zoneinfo bundle when first needed
+_all_tz_select_array = []
+
+DAY_NAMES = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# Schedule times always look like '<Day> <H:MM[am|pm]> <TZ>', which can be
+# parsed much faster than by the general purpose parser
+DAY_TIME_RE = re.compile(r'^\s*([A-Za-z]+)\s+(\d{1,2}):(\d\d)\s*([AaPp][Mm])?\s+'
+    r'([A-Z]{1,5}|[A-Za-z_]+(?:/[A-Za-z0-9_+-]+)+)\s*$')
+# Filled in from the parser's day names by load_parser
+WEEKDAYS = {}
+
+# Each post parses the same few schedule times with a default that only
+# changes at local midnight, so remember the results
+PARSE_CACHE_SIZE = 512
+parse_cache = None
+
+# Compiled schedules kept per instance, keyed by the schedule JSON
+COMPILED_CACHE_SIZE = 256
+_compiled_cache = {}
+# A set point changes just after its scheduled time, once now is past it
+CHANGE_STEP = timedelta(microseconds=1)
+
+# Requests on other threads can use the lazily built objects above as soon as
+# they're set, so each is built first and then put in place under this lock
+_load_lock = threading.Lock()
+
+
+def load_parser():
+  """Import dateutil's parser and set up the objects built from it."""
+  global parser, parse_cache
+  if not parser:
+    from dateutil import parser as date_parser
+    weekdays = dict((name.lower(), idx)
+        for idx, names in enumerate(date_parser.parserinfo.WEEKDAYS) for name in names)
+    cache = date_parser.parsecache(PARSE_CACHE_SIZE)
+    with _load_lock:
+      if not parser:
+        WEEKDAYS.update(weekdays)
+        parse_cache = cache
+        parser = date_parser
+  return parser
+
+def parse_cache_stats():
+  """Return the parse cache's (hits, misses), zeros until it's been set up."""
+  if parse_cache is None:
+    return 0, 0
+  info = parse_cache.info()
+  return info['hits'], info['misses']
+
+def load_zoneinfo():
+  global zoneinfo
+  if not zoneinfo:
+    from dateutil import zoneinfo
+  return zoneinfo
+
+def get_tzinfos():
+  if not tzinfos:
+    built = dict([(t[1], tz.tzstr(t[2])) for t in time_zones])
+    with _load_lock:
+      if not tzinfos:
+        tzinfos.update(built)
+  return tzinfos
+
+def get_time_zone(name, iana_only=False):
+  """Look up one of the time_zones abbreviations or an IANA zone name.
+
+  With iana_only, names without a '/' are only looked up in tzinfos, which
+  keeps the result the same as the general parser's for anything else.
+  """
+  time_zone = get_tzinfos().get(name)
+  if time_zone is None and (not iana_only or '/' in name):
+    time_zone = load_zoneinfo().gettz(name)
+  return time_zone
+
+def get_tz_select_array():
+  if not _all_tz_select_array:
+    built = tz_select_array + [{'abbr': name, 'name': name.replace('_', ' ')}
+        for name in load_zoneinfo().zonenames()]
+    with _load_lock:
+      if not _all_tz_select_array:
+        _all_tz_select_array[:] = built
+  return _all_tz_select_array
+
+
+class ScheduleProvider(object):
+  """A source for weekly schedules.
+
+  Providers turn raw content into a list of entries with 'day', 'time' and
+  'temperature' keys. Remote providers also return the URL to fetch the
+  content from, local providers get content stored with the thermostat.
+  """
+  name = None
+  label = None
+  remote = False
+
+  def get_url(self, source_id):
+    return None
+
+  def get_entries(self, source_id, content, timezone):
+    raise NotImplementedError
+
+
+class SheetProvider(ScheduleProvider):
+  name = 'sheet'
+  label = 'Google spreadsheet'
+  remote = True
+
+  data_keys = [
+    ('gsx$day', 'day'),
+    ('gsx$time', 'time'),
+    ('gsx$temperature', 'temperature'),
+  ]
+
+  def get_url(self, source_id):
+    return 'https://spreadsheets.google.com/feeds/list/%s/od6/public/values?alt=json' % source_id
+
+  def get_entries(self, source_id, content, timezone):
+    try:
+      data = json.loads(content)
+    except ValueError:
+      logging.error('Error: invalid JSON format for spreadsheet %s' % source_id)
+      return False
+
+    if 'feed' not in data or 'entry' not in data['feed']:
+      logging.warning('Warning: invalid data format for %s' % source_id)
+      return False
+
+    entries = []
+    for entry in data['feed']['entry']:
+      result = {}
+      for entry_key, result_key in self.data_keys:
+        if entry_key not in entry or '$t' not in entry[entry_key]:
+          logging.warning('Warning: key not found for %s: %s' % (source_id, entry_key))
+          return False
+        result[result_key] = entry[entry_key]['$t']
+      entries.append(result)
+    return entries
+
+
+class UploadProvider(ScheduleProvider):
+  """Schedule pasted in as JSON or CSV with day, time and temperature columns."""
+  name = 'upload'
+  label = 'Uploaded JSON or CSV'
+
+  keys = ('day', 'time', 'temperature')
+
+  def get_entries(self, source_id, content, timezone):
+    content = content.strip()
+    if content.startswith('[') or content.startswith('{'):
+      return self.get_json_entries(source_id, content)
+    return self.get_csv_entries(source_id, content)
+
+  def get_json_entries(self, source_id, content):
+    try:
+      data = json.loads(content)
+    except ValueError:
+      logging.warning('Warning: invalid JSON format for uploaded schedule %s' % source_id)
+      return False
+    if isinstance(data, dict):
+      data = data.get('schedule', [])
+    if not isinstance(data, list):
+      logging.warning('Warning: no list of entries in uploaded schedule %s' % source_id)
+      return False
+
+    entries = []
+    for entry in data:
+      if not isinstance(entry, dict) or any(key not in entry for key in self.keys):
+        logging.warning('Warning: invalid entry in uploaded schedule %s: %s' % (source_id, entry))
+        return False
+      entries.append(dict((key, unicode(entry[key])) for key in self.keys))
+    return entries
+
+  def get_csv_entries(self, source_id, content):
+    entries = []
+    for row in csv.reader(StringIO.StringIO(content.encode('utf-8'))):
+      row = [col.strip() for col in row]
+      if not any(row):
+        continue
+      # Skip an optional header row
+      if not entries and row[0].lower() == 'day':
+        continue
+      if len(row) != 3:
+        logging.warning('Warning: invalid row in uploaded schedule %s: %s' % (source_id, row))
+        return False
+      entries.append(dict(zip(self.keys, row)))
+    return entries
+
+
+class ICalProvider(ScheduleProvider):
+  """Schedule exported from a calendar as iCalendar events.
+
+  Each VEVENT is a set point change at its DTSTART, with the temperature taken
+  from the SUMMARY. Weekly and daily RRULEs expand to the days they repeat on.
+  Times are read as wall clock times in the thermostat's time zone unless they
+  are in UTC.
+  """
+  name = 'ical'
+  label = 'iCalendar file'
+
+  ical_days = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+  temperature_re = re.compile(r'-?\d+')
+
+  def get_entries(self, source_id, content, timezone):
+    entries = []
+    event = None
+    for line in self.unfold(content):
+      name, _, value = line.partition(':')
+      name = name.split(';')[0].upper()
+      if name == 'BEGIN' and value == 'VEVENT':
+        event = {}
+      elif name == 'END' and value == 'VEVENT':
+        if event is None:
+          logging.warning('Warning: END:VEVENT without BEGIN:VEVENT in calendar %s' % source_id)
+          return False
+        event_entries = self.get_event_entries(source_id, event, timezone)
+        if event_entries is False:
+          return False
+        entries.extend(event_entries)
+        event = None
+      elif event is not None:
+        event[name] = value
+    return entries
+
+  def unfold(self, content):
+    lines = []
+    for line in content.splitlines():
+      if line[:1] in (' ', '\t') and lines:
+        lines[-1] += line[1:]
+      elif line.strip():
+        lines.append(line.strip())
+    return lines
+
+  def get_event_entries(self, source_id, event, timezone):
+    dtstart = event.get('DTSTART', '')
+    summary = self.temperature_re.search(event.get('SUMMARY', ''))
+    try:
+      start = datetime.strptime(dtstart.rstrip('Z')[:15], '%Y%m%dT%H%M%S')
+    except ValueError:
+      logging.warning('Warning: invalid DTSTART in calendar %s: %s' % (source_id, dtstart))
+      return False
+    if not summary:
+      logging.warning('Warning: no temperature in calendar %s event at %s' % (source_id, dtstart))
+      return False
+    if dtstart.endswith('Z'):
+      start = start.replace(tzinfo=tz.tzutc()).astimezone(get_time_zone(timezone))
+
+    days = [start.weekday()]
+    rrule = dict(part.split('=', 1) for part in event.get('RRULE', '').split(';') if '=' in part)
+    if rrule.get('FREQ') == 'DAILY':
+      days = range(7)
+    elif rrule.get('FREQ') == 'WEEKLY' and 'BYDAY' in rrule:
+      # Ignore any ordinal prefix, which only makes sense for monthly rules
+      days = [self.ical_days.index(day[-2:]) for day in rrule['BYDAY'].split(',')
+          if day[-2:] in self.ical_days]
+
+    time_str = start.strftime('%H:%M')
+    return [{'day': DAY_NAMES[day], 'time': time_str, 'temperature': summary.group(0)}
+        for day in days]
+
+
+PROVIDERS = dict((p.name, p) for p in [SheetProvider(), UploadProvider(), ICalProvider()])
+default_provider = SheetProvider.name
+provider_select_array = [{'name': p.name, 'label': p.label}
+    for p in sorted(PROVIDERS.values(), key=lambda p: not p.remote)]
+
+def get_provider(name):
+  return PROVIDERS.get(name or default_provider)
+
+def get_schedule(provider, source_id, timezone, content=None):
+  """Load a schedule and compile it.
+
+  Returns the compiled schedule (or False) and a hash of the raw content.
+  """
+  if provider.remote:
+    import urllib2
+    url = provider.get_url(source_id)
+    try:
+      response = urllib2.urlopen(url)
+      content = response.read()
+    except urllib2.URLError:
+      logging.warning('Warning: could not retrieve schedule data for %s' % source_id)
+      return False, None
+
+  return compile_schedule(provider, source_id, content, timezone), hash_schedule(content)
+
+def hash_schedule(content):
+  if isinstance(content, unicode):
+    content = content.encode('utf-8')
+  return hashlib.md5(content).hexdigest()
+
+def compile_schedule(provider, source_id, content, timezone):
+  entries = provider.get_entries(source_id, content, timezone)
+  if not entries:
+    return False
+
+  schedule = []
+  for entry in entries:
+    day_time = '%s %s %s' % (entry['day'], entry['time'], timezone)
+    try:
+      # TODO: Ensure valid timezone
+      parse_day_time(day_time, CompiledSchedule.reference_monday)
+    except ValueError:
+      logging.warning('Warning: invalid time format for %s: %s' % (source_id, day_time))
+      return False
+    try:
+      temperature = int(entry['temperature'])
+    except ValueError:
+      logging.warning('Warning: invalid temperature format for %s: %s'
+          % (source_id, entry['temperature']))
+      return False
+
+    schedule.append({'dt': day_time, 't': temperature})
+
+  return json.dumps(schedule, separators=(',', ':'))
+
+def parse_day_time(dt_str, default):
+  """Parse a schedule time, giving the same result as parser.parse.
+
+  Strings that don't match the usual schedule format fall back to the general
+  parser. Results are cached in parse_cache.
+  """
+  load_parser()
+  return parse_cache.memoize((dt_str, default), _parse_day_time, dt_str, default)
+
+def _parse_day_time(dt_str, default):
+  match = DAY_TIME_RE.match(dt_str)
+  if match:
+    day, hour, minute, ampm, abbr = match.groups()
+    weekday = WEEKDAYS.get(day.lower())
+    time_zone = get_time_zone(abbr, iana_only=True)
+    hour = int(hour)
+    minute = int(minute)
+    if weekday is not None and time_zone is not None and hour < 24 and minute < 60:
+      if ampm:
+        ampm = ampm.lower()
+        if ampm == 'pm' and hour < 12:
+          hour += 12
+        elif ampm == 'am' and hour == 12:
+          hour = 0
+      dt = default.replace(hour=hour, minute=minute)
+      # The next matching day on or after the default, like relativedelta(weekday=...)
+      dt += timedelta(days=(weekday - dt.weekday()) % 7)
+      return dt.replace(tzinfo=time_zone)
+  return parse_cache.parse(dt_str, tzinfos=get_tzinfos(), default=default)
+
+def normalize(dt_str, local_today, now=None):
+  dt = parse_day_time(dt_str, local_today).astimezone(tz.tzutc()).replace(tzinfo=None)
+
+  # Normalize each datetime to within one week from now
+  if now is None:
+    now = datetime.utcnow()
+  oneweek = timedelta(days=7)
+  oneweek_from_now = now + oneweek
+  while dt < now:
+    dt += oneweek
+  while dt > oneweek_from_now:
+    dt -= oneweek
+  return dt
+
+def get_next_event(schedule, now=None):
+  schedule = json.loads(schedule)
+  # TODO: This needs some clean up
+  time_zone = get_time_zone(schedule[0]['dt'].split(' ')[-1])
+  midnight = {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0, 'tzinfo': None}
+  utc_now = now or datetime.utcnow()
+  local_today = utc_now.replace(tzinfo=tz.tzutc()).astimezone(time_zone).replace(**midnight)
+  current_schedule = [{
+    'dt': normalize(entry['dt'], local_today, now),
+    't': entry['t'],
+  } for entry in schedule]
+  current_schedule.sort(key=lambda x:x['dt'])
+  return current_schedule[-1]['t'] * 10, current_schedule[0]['dt']
+
+
+class CompiledSchedule(object):
+  """A schedule parsed once into local (weekday, hour, minute, temperature, tzinfo) events."""
+  # Any Monday works, parsing a day name relative to it gives that day's weekday
+  reference_monday = datetime(2014, 1, 6)
+
+  def __init__(self, schedule):
+    entries = json.loads(schedule)
+    self.time_zone = get_time_zone(entries[0]['dt'].split(' ')[-1])
+    # Entries in schedule order, keeping each entry's own time zone
+    self.events = []
+    for entry in entries:
+      dt = parse_day_time(entry['dt'], self.reference_monday)
+      self.events.append((dt.weekday(), dt.hour, dt.minute, entry['t'] * 10, dt.tzinfo))
+
+  def next_event(self, now=None):
+    """Same result as get_next_event, without parsing the schedule again."""
+    if now is None:
+      now = datetime.utcnow()
+    local_now = now.replace(tzinfo=tz.tzutc()).astimezone(self.time_zone)
+    local_today = datetime(local_now.year, local_now.month, local_now.day)
+    today_weekday = local_today.weekday()
+    oneweek = timedelta(days=7)
+    oneweek_from_now = now + oneweek
+
+    first = last = None
+    for idx, (weekday, hour, minute, set_temp, time_zone) in enumerate(self.events):
+      # Local time on or after today, converted with the offset on that day
+      local = local_today + timedelta(days=(weekday - today_weekday) % 7, hours=hour, minutes=minute)
+      if time_zone is not None:
+        local -= time_zone.utcoffset(local)
+      dt = local
+      while dt < now:
+        dt += oneweek
+      while dt > oneweek_from_now:
+        dt -= oneweek
+      key = (dt, idx)
+      if first is None or key < first[0]:
+        first = (key, dt)
+      if last is None or key > last[0]:
+        last = (key, set_temp)
+    return last[1], first[1]
+
+  def transitions(self, start):
+    """Generate (utc, local, set_temp) for each scheduled change at or after start.
+
+    Start and the returned times are naive datetimes. Each change is the one
+    next_event gives, to the set point it gives just after that time, which is
+    what a post from the thermostat applies. This keeps the previews in step
+    with the posts, DST weeks included.
+    """
+    now = start
+    while True:
+      utc = self.next_event(now)[1]
+      now = utc + CHANGE_STEP
+      yield utc, utc_to_local(utc, self.time_zone), self.next_event(now)[0]
+
+  def set_point_at(self, now):
+    """Return the scheduled set temperature at now."""
+    return self.next_event(now)[0]
+
+def get_compiled_schedule(schedule):
+  compiled = _compiled_cache.get(schedule)
+  if compiled is None:
+    if len(_compiled_cache) >= COMPILED_CACHE_SIZE:
+      _compiled_cache.clear()
+    compiled = _compiled_cache[schedule] = CompiledSchedule(schedule)
+  return compiled
+
+def local_to_utc(dt, local_tz):
+  return dt.replace(tzinfo=local_tz).astimezone(tz.tzutc()).replace(tzinfo=None)
+
+def utc_to_local(dt, local_tz):
+  return dt.replace(tzinfo=tz.tzutc()).astimezone(local_tz).replace(tzinfo=None)
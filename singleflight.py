@@ -0,0 +1,59 @@
+"""Coalesce concurrent calls for the same key within an instance.
+
+With threadsafe enabled an instance serves several requests at once, and a
+popular thermostat's page can be loaded by many of them just as its cached
+data expires. Group.do runs the function for the first caller of a key, and
+callers that arrive while it's running wait and get the same result, or the
+same exception. Nothing is kept once the call finishes, so later callers run
+it again.
+"""
+import sys
+import threading
+
+
+class _Call(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+
+
+class Group(object):
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.calls = {}
+    self.shared = 0
+    self.led = 0
+
+  def do(self, key, fn, *args):
+    """Return fn(*args), sharing the call with concurrent callers of key."""
+    with self.lock:
+      call = self.calls.get(key)
+      leader = call is None
+      if leader:
+        call = self.calls[key] = _Call()
+        self.led += 1
+      else:
+        self.shared += 1
+    if not leader:
+      call.done.wait()
+      if call.exc_info:
+        raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+      return call.result
+
+    try:
+      call.result = fn(*args)
+      return call.result
+    except BaseException:
+      # Not just Exception, App Engine's DeadlineExceededError isn't one, and
+      # waiters would otherwise return None as if it had succeeded
+      call.exc_info = sys.exc_info()
+      raise
+    finally:
+      with self.lock:
+        del self.calls[key]
+      call.done.set()
+
+  def stats(self):
+    """Return the (shared, led) call counts, for metrics.register_cache."""
+    return self.shared, self.led
@@ -6,7 +6,7 @@
 var myApp = angular.module('Thermostat', []);
 
 myApp.controller('ThermostatCtrl',
-    ['$scope', '$http', '$timeout', function($scope, $http, $timeout) {
+    ['$scope', '$http', '$q', '$timeout', function($scope, $http, $q, $timeout) {
   $scope.info = info_from_server;
 
   $scope.debug = function() {
@@ -27,6 +27,14 @@ myApp.controller('ThermostatCtrl',
       });
   };
 
+  // Show the next change of the set temperature
+  if ($scope.info.claimed) {
+    $http.get('/preview?id=' + $scope.info.id + '&n=1')
+      .success(function(data) {
+        $scope.next = data.transitions[0];
+      });
+  }
+
   var timeout = null;
   $scope.changeSetTemp = function(amt, toggleHold) {
     $scope.info.set_temp += amt;
@@ -34,6 +42,7 @@ myApp.controller('ThermostatCtrl',
       $scope.info.hold = !$scope.info.hold;
     }
     var update_set_temp = function() {
+      timeout = null;
       $http.get('/post?id=' + $scope.info.id + '&k=' + $scope.info.token +
           '&s=' + $scope.info.set_temp +'&d=' + ($scope.info.hold ? 'y' : 'n'));
     };
@@ -72,8 +81,6 @@ myApp.controller('ThermostatCtrl',
       width = 960 - margin.left - margin.right,
       height = 500 - margin.top - margin.bottom;
 
-  var parseTime = d3.time.format.utc('%Y-%m-%d %H:%M:%S').parse;
-
   var x = d3.time.scale()
       .range([0, width]);
 
@@ -91,11 +98,27 @@ myApp.controller('ThermostatCtrl',
       .orient('left')
       .ticks(5);
 
+  var gridAxis = d3.svg.axis()
+      .scale(y)
+      .orient('left')
+      .ticks(5)
+      .tickSize(-width, 0, 0)
+      .tickFormat('');
+
+  var zoom = d3.behavior.zoom()
+      .on('zoom', function() {
+        // Panned or zoomed away from the chosen range
+        $scope.$apply(function() { $scope.range = null; });
+        showView();
+      });
+
   var line = d3.svg.line()
       .x(function(d) { return x(d.time); })
       .y(function(d) { return y(d.value); });
 
-  var svg = d3.select('#graph').append('svg')
+  var svg = d3.select('#graph').style('position', 'relative').append('svg')
+      // Positioned so it stays above the canvas
+      .style('position', 'relative')
       .attr('width', width + margin.left + margin.right)
       .attr('height', height + margin.top + margin.bottom)
     .append('g')
@@ -113,20 +136,291 @@ myApp.controller('ThermostatCtrl',
   //   return;
   // }
 
-  // Map data into correct structure for D3
-  var temps = [];
-  var hums = [];
-  var setTemps = [];
-  var minValue = 100;
-  var maxValue = 0;
-
-  // Data is injected into html by server script
-  if ('data' in $scope.info) {
-    $scope.info.data.forEach(function(d) {
-      var time = parseTime(d[0]);
-      var temp = +d[1] / 10;
-      var hum = +d[2] / 10;
-      var setTemp = +d[3] / 10;
+  // Readings of the last day, newest first
+  var rows = [];
+  var graph = null;
+  // Milliseconds to wait before polling again after an error
+  var POLL_RETRY_DELAY = 30000;
+  var DAY = 24 * 3600 * 1000;
+
+  // The first range is the live view of the readings, the others show the
+  // averaged tiles of the history
+  $scope.ranges = [
+    {label: '1 day', days: 1},
+    {label: '7 days', days: 7},
+    {label: '30 days', days: 30},
+    {label: '1 year', days: 365}
+  ];
+  $scope.range = $scope.ranges[0];
+  // In canvas mode the series are drawn on a canvas under the SVG, which
+  // still has the axes, labels and titles
+  $scope.canvasMode = window.localStorage && localStorage.getItem('renderer') === 'canvas';
+  var context = null;
+  // Domains and the tail's start of the last canvas drawing
+  var drawn = null;
+  // Milliseconds of room left after the newest reading in the live canvas
+  // view, so new readings only redraw the tail
+  var TAIL_ROOM = 3600 * 1000;
+  var tiles = $scope.info.tiles;
+  var tileCache = {};
+  var viewCount = 0;
+
+  $scope.toggleRenderer = function() {
+    $scope.canvasMode = !$scope.canvasMode;
+    if (window.localStorage) {
+      localStorage.setItem('renderer', $scope.canvasMode ? 'canvas' : 'svg');
+    }
+    if (graph) {
+      drawn = null;
+      context.clearRect(0, 0, width, height);
+      $scope.setRange($scope.range || $scope.ranges[0]);
+    }
+  };
+
+  $scope.setRange = function(range) {
+    $scope.range = range;
+    if (!graph) {
+      return;
+    }
+    if (range === $scope.ranges[0]) {
+      updateGraph(rows);
+      return;
+    }
+    var now = new Date();
+    x.domain([new Date(now - range.days * DAY), now]);
+    zoom.x(x);
+    showView();
+  };
+
+  // Fetch the readings separately so the page itself doesn't change with the
+  // data, the browser revalidates them with the ETag on each load
+  if ($scope.info.claimed) {
+    $http.get('/readings?id=' + $scope.info.id)
+      .success(function(readings) {
+        showStatus(readings);
+        rows = decodeReadings(readings.data);
+        drawGraph();
+        poll(readings.version, readings.key);
+      });
+  }
+
+  function showStatus(readings) {
+    $scope.info.heat = readings.heat;
+    // Don't undo a change to the set temperature that hasn't been sent yet
+    if (!timeout) {
+      $scope.info.hold = readings.hold;
+      $scope.info.set_temp = readings.set_temp;
+    }
+  }
+
+  // Wait for new readings. The server answers once there are some, or with no
+  // content after a while, and each answer starts the next poll.
+  function poll(version, key) {
+    $http.get('/readings/poll?id=' + $scope.info.id + '&since=' + version + '&k=' + key)
+      .success(function(update, status) {
+        if (status === 200) {
+          showStatus(update);
+          // The newest reading was averaged with newer posts
+          if (update.replace) {
+            rows.shift();
+          }
+          rows = decodeReadings(update.data).concat(rows);
+          var dayAgo = new Date(Date.now() - 24 * 3600 * 1000);
+          while (rows.length && rows[rows.length - 1].time <= dayAgo) {
+            rows.pop();
+          }
+          version = update.version;
+          key = update.key;
+          if ($scope.range === $scope.ranges[0]) {
+            updateGraph(rows);
+          }
+        }
+        poll(version, key);
+      })
+      .error(function() {
+        $timeout(function() { poll(version, key); }, POLL_RETRY_DELAY);
+      });
+  }
+
+  // Expand the columns from chart.encode_rows into rows, newest first.
+  // Times step back from the base epoch, the set point is run-length encoded.
+  function decodeReadings(data) {
+    var rows = [];
+    var time = data.base;
+    var run = 0;
+    var runLeft = 0;
+    var setTemp = null;
+    for (var i = 0; i < data.dt.length; i++) {
+      time -= data.dt[i];
+      if (runLeft === 0) {
+        setTemp = data.s[run];
+        runLeft = data.s[run + 1];
+        run += 2;
+      }
+      runLeft--;
+      rows.push({
+        time: new Date(time * 1000),
+        temp: data.t[i],
+        hum: data.h[i],
+        setTemp: setTemp
+      });
+    }
+    return rows;
+  }
+
+  // Show the readings of the last day if that's all that's in view, otherwise
+  // the tiles of the level whose buckets fit the width
+  function showView() {
+    var domain = x.domain();
+    if (domain[0] >= Date.now() - DAY) {
+      updateGraph(rows.filter(function(d) {
+        return d.time >= domain[0] && d.time <= domain[1];
+      }), domain);
+      return;
+    }
+    var span = (domain[1] - domain[0]) / 1000;
+    var level = 0;
+    while (level < tiles.steps.length - 1 && span / tiles.steps[level] > width) {
+      level++;
+    }
+    var tileSpan = tiles.steps[level] * tiles.points;
+    var requests = [];
+    for (var index = Math.floor(domain[0] / 1000 / tileSpan);
+         index <= Math.floor(domain[1] / 1000 / tileSpan); index++) {
+      requests.push(getTile(level, index));
+    }
+    var view = ++viewCount;
+    $q.all(requests).then(function(loaded) {
+      // Skip it if the view has moved on while loading
+      if (view === viewCount) {
+        updateGraph(tileRows(loaded, domain), domain);
+      }
+    });
+  }
+
+  function getTile(level, index) {
+    var key = level + ':' + index;
+    if (!tileCache[key]) {
+      tileCache[key] = $http.get('/tiles?id=' + $scope.info.id + '&level=' + level +
+          '&index=' + index + '&v=' + tiles.version)
+        .then(function(response) {
+          var tile = response.data;
+          // The newest tile is still filling, so fetch it again next time
+          if ((tile.start + tile.step * tiles.points) * 1000 > Date.now()) {
+            delete tileCache[key];
+          }
+          return tile;
+        });
+    }
+    return tileCache[key];
+  }
+
+  // Turn the buckets of tiles, oldest first, into rows, newest first. One
+  // bucket either side of the domain is kept so the lines reach the edges.
+  function tileRows(loaded, domain) {
+    var points = [];
+    for (var i = loaded.length - 1; i >= 0; i--) {
+      var tile = loaded[i];
+      for (var j = tile.n.length - 1; j >= 0; j--) {
+        var time = new Date((tile.start + (j + 0.5) * tile.step) * 1000);
+        if (!tile.n[j] || time - domain[1] > tile.step * 1000 ||
+            domain[0] - time > tile.step * 1000) {
+          continue;
+        }
+        points.push({
+          time: time,
+          temp: tile.t[j],
+          hum: tile.h[j],
+          setTemp: tile.s[j]
+        });
+      }
+    }
+    return points;
+  }
+
+  // Create the graph's elements, updateGraph fills them in
+  function drawGraph() {
+    graph = {};
+    var ratio = window.devicePixelRatio || 1;
+    var canvas = d3.select('#graph').insert('canvas', 'svg')
+        .attr('width', width * ratio)
+        .attr('height', height * ratio)
+        .style('position', 'absolute')
+        .style('left', margin.left + 'px')
+        .style('top', margin.top + 'px')
+        .style('width', width + 'px')
+        .style('height', height + 'px');
+    context = canvas.node().getContext('2d');
+    context.scale(ratio, ratio);
+
+    svg.append('defs').append('clipPath')
+        .attr('id', 'clip')
+      .append('rect')
+        .attr('width', width)
+        .attr('height', height);
+    graph.xAxis = svg.append('g')
+        .attr('class', 'x axis')
+        .attr('transform', 'translate(0,' + height + ')');
+    graph.yAxis = svg.append('g')
+        .attr('class', 'y axis');
+    graph.grid = svg.append('g')
+        .attr('class', 'grid');
+
+    graph.series = svg.selectAll('.series')
+        .data([0, 1, 2])
+        .enter().append('g')
+        .attr('class', 'series');
+    graph.series.append('path')
+        .attr('class', 'line')
+        .attr('clip-path', 'url(#clip)');
+    graph.series.append('text')
+        .attr('x', 3)
+        .attr('dy', '.35em')
+        .style('font-size', '10px');
+
+    // Title and subtitles
+    graph.title = svg.append('text')
+        .attr('x', (width / 2))
+        .attr('y', 0)
+        .attr('text-anchor', 'middle')
+        .style('font-size', '16px');
+    graph.time = svg.append('text')
+        .attr('x', (width / 2))
+        .attr('y', 18)
+        .attr('text-anchor', 'middle')
+        .style('font-size', '12px');
+    graph.heat = svg.append('text')
+        .attr('x', (width / 2))
+        .attr('y', 32)
+        .attr('text-anchor', 'middle')
+        .style('font-size', '12px');
+
+    // Catches the mouse and touches for zooming and panning
+    svg.append('rect')
+        .attr('width', width)
+        .attr('height', height)
+        .style('fill', 'none')
+        .style('pointer-events', 'all')
+        .call(zoom);
+
+    updateGraph(rows);
+  }
+
+  // Draw rows, newest first, into the existing elements. Without a domain the
+  // graph fits the rows, as the live view does.
+  function updateGraph(points, domain) {
+    // Map data into correct structure for D3
+    var temps = [];
+    var hums = [];
+    var setTemps = [];
+    var minValue = 100;
+    var maxValue = 0;
+
+    points.forEach(function(d) {
+      var time = d.time;
+      var temp = d.temp / 10;
+      var hum = d.hum / 10;
+      var setTemp = d.setTemp / 10;
 
       temps.push({
         time: time,
@@ -143,122 +437,182 @@ myApp.controller('ThermostatCtrl',
       minValue = Math.min(minValue, temp, hum, setTemp);
       maxValue = Math.max(maxValue, temp, hum, setTemp);
     });
-  }
 
-  var lastValue = null;
-  if (temps[0]) {
-    lastValue = {
-      'temp': temps[0].value,
-      'hum': hums[0].value,
-      'set': setTemps[0].value,
-      'time': temps[0].time
-    };
-  } else {
-    lastValue = {
-      'temp': '',
-      'hum': '',
-      'set': '',
-      'time': ''
+    var lastValue = null;
+    if (temps[0]) {
+      lastValue = {
+        'temp': temps[0].value,
+        'hum': hums[0].value,
+        'set': setTemps[0].value,
+        'time': temps[0].time
+      };
+    } else {
+      lastValue = {
+        'temp': '',
+        'hum': '',
+        'set': '',
+        'time': ''
+      };
+    }
+    var labels = {
+      temp: 'Temperature: ' + lastValue['temp'] + '°F',
+      hum: 'Humidity: ' + lastValue['hum'] + '%',
+      setTemp: 'Set temp: ' + lastValue['set'] + '°F'
     };
-  }
-  var labels = {
-    temp: 'Temperature: ' + lastValue['temp'] + '°F',
-    hum: 'Humidity: ' + lastValue['hum'] + '%',
-    setTemp: 'Set temp: ' + lastValue['set'] + '°F'
-  };
-  color.domain([labels.temp, labels.hum, labels.setTemp]);
+    color.domain([labels.temp, labels.hum, labels.setTemp]);
 
-  if (temps[0]) {
-    var spread = Math.max(18, maxValue - minValue) / height * 12;
-    distribute(lastValue, ['temp', 'hum', 'set'], spread);
-  }
+    if (temps[0]) {
+      var spread = Math.max(18, maxValue - minValue) / height * 12;
+      distribute(lastValue, ['temp', 'hum', 'set'], spread);
+    }
+
+    var data = [
+      {
+        name: labels.temp,
+        values: temps,
+        labelValue: lastValue['temp']
+      },
+      {
+        name: labels.hum,
+        values: hums,
+        labelValue: lastValue['hum']
+      },
+      {
+        name: labels.setTemp,
+        values: setTemps,
+        labelValue: lastValue['set']
+      }
+    ];
+
+    var live = !domain;
+    var yDomain = [minValue - 5, maxValue + 5];
+    if (live) {
+      domain = d3.extent(data[0].values, function(d) { return d.time; });
+      if ($scope.canvasMode && temps[0]) {
+        var newest = temps[0].time;
+        if (drawn && drawn.live && newest <= drawn.x[1] &&
+            yDomain[0] >= drawn.y[0] && yDomain[1] <= drawn.y[1]) {
+          // Still fits, so keep the scales and only draw the tail
+          domain = drawn.x;
+          yDomain = drawn.y;
+        } else {
+          domain = [new Date(newest - DAY), new Date(+newest + TAIL_ROOM)];
+        }
+      }
+    }
+    x.domain(domain);
+    y.domain(yDomain);
+    if (live) {
+      zoom.x(x);
+    }
 
-  var data = [
-    {
-      name: labels.temp,
-      values: temps,
-      labelValue: lastValue['temp']
-    },
-    {
-      name: labels.hum,
-      values: hums,
-      labelValue: lastValue['hum']
-    },
-    {
-      name: labels.setTemp,
-      values: setTemps,
-      labelValue: lastValue['set']
+    // Draw the axes and grid
+    graph.xAxis.call(xAxis);
+    graph.yAxis.call(yAxis);
+    graph.grid.call(gridAxis);
+
+    // Draw the data
+    graph.series.data(data);
+    if ($scope.canvasMode) {
+      graph.series.select('path').attr('d', null);
+      drawCanvas(data, live);
+    } else {
+      graph.series.select('path')
+          .attr('d', function(d) { return line(d.values); })
+          .style('stroke', function(d) { return color(d.name); });
     }
-  ];
 
-  x.domain(d3.extent(data[0].values, function(d) { return d.time; }));
-  y.domain([minValue - 5, maxValue + 5]);
-
-  // Draw the axes
-  svg.append('g')
-      .attr('class', 'x axis')
-      .attr('transform', 'translate(0,' + height + ')')
-      .call(xAxis);
-
-  svg.append('g')
-      .attr('class', 'y axis')
-      .call(yAxis)
-
-  // Draw the grid
-  svg.append('g')
-      .attr('class', 'grid')
-      .call(yAxis
-          .tickSize(-width, 0, 0)
-          .tickFormat('')
-      )
-
-  // Draw the data
-  var series = svg.selectAll('.series')
-      .data(data)
-      .enter().append('g')
-      .attr('class', 'series');
-
-  series.append('path')
-      .attr('class', 'line')
-      .attr('d', function(d) { return line(d.values); })
-      .style('stroke', function(d) { return color(d.name); });
-
-  // Data is in reverse time order, so position text next to first item in array
-  if (temps.length > 0) {
-    series.append('text')
-        .datum(function(d) { return {name: d.name, time: d.values[0].time, value: d.labelValue}; })
-        .attr('transform', function(d) {
-          return 'translate(' + x(d.time) + ',' + y(d.value) + ')';
-        })
-        .attr('x', 3)
-        .attr('dy', '.35em')
-        .style('font-size', '10px')
-        .text(function(d) { return d.name; });
+    // Data is in reverse time order, so position text next to first item in array
+    var seriesLabels = graph.series.select('text');
+    if (temps.length > 0) {
+      seriesLabels
+          .datum(function(d) { return {name: d.name, time: d.values[0].time, value: d.labelValue}; })
+          .attr('transform', function(d) {
+            return 'translate(' + x(d.time) + ',' + y(d.value) + ')';
+          })
+          .text(function(d) { return d.name; });
+    } else {
+      seriesLabels.text('');
+    }
+
+    var title = $scope.info.title || 'Temperature & Humidity';
+    if (temps.length < 1) {
+      title = 'No data to display';
+    }
+    graph.title.text(title);
+    graph.time.text(lastValue['time'].toLocaleString());
+    graph.heat.text('Heat: ' + ($scope.info.heat ? 'on' : 'off'));
   }
 
-  // Title and subtitles
-  var title = $scope.info.title || 'Temperature & Humidity';
-  if (temps.length < 1) {
-    title = 'No data to display';
+  // Draw the series on the canvas. When the live view's scales haven't
+  // changed only the tail is redrawn, from the reading before the previous
+  // newest one, since the newest may have been averaged with later posts.
+  function drawCanvas(data, live) {
+    var xDomain = x.domain();
+    var yDomain = y.domain();
+    var since = null;
+    if (live && drawn && drawn.live && +xDomain[0] === +drawn.x[0] && +xDomain[1] === +drawn.x[1] &&
+        yDomain[0] === drawn.y[0] && yDomain[1] === drawn.y[1]) {
+      since = drawn.tail;
+      context.clearRect(x(since), 0, width, height);
+    } else {
+      context.clearRect(0, 0, width, height);
+    }
+    data.forEach(function(series) {
+      var values = series.values;
+      if (since) {
+        values = values.filter(function(d) { return d.time >= since; });
+      }
+      drawLine(values, color(series.name));
+    });
+    var values = data[0].values;
+    drawn = {
+      live: live,
+      x: xDomain,
+      y: yDomain,
+      tail: values.length > 1 ? values[1].time : xDomain[0]
+    };
+  }
+
+  // Stroke values, newest first, keeping the first, lowest, highest and last
+  // point in each pixel column, which looks the same as drawing them all
+  function drawLine(values, stroke) {
+    context.strokeStyle = stroke;
+    context.lineWidth = 1.5;
+    context.beginPath();
+    var started = false;
+    var column = null;
+    var first, low, high, last;
+    function flush() {
+      if (started) {
+        context.lineTo(column, first);
+      } else {
+        context.moveTo(column, first);
+        started = true;
+      }
+      context.lineTo(column, low);
+      context.lineTo(column, high);
+      context.lineTo(column, last);
+    }
+    for (var i = values.length - 1; i >= 0; i--) {
+      var px = Math.round(x(values[i].time));
+      var py = y(values[i].value);
+      if (px !== column) {
+        if (column !== null) {
+          flush();
+        }
+        column = px;
+        first = low = high = last = py;
+      } else {
+        low = Math.min(low, py);
+        high = Math.max(high, py);
+        last = py;
+      }
+    }
+    if (column !== null) {
+      flush();
+    }
+    context.stroke();
   }
-  svg.append('text')
-      .attr('x', (width / 2))
-      .attr('y', 0)
-      .attr('text-anchor', 'middle')
-      .style('font-size', '16px')
-      .text(title);
-  svg.append('text')
-      .attr('x', (width / 2))
-      .attr('y', 18)
-      .attr('text-anchor', 'middle')
-      .style('font-size', '12px')
-      .text(lastValue['time'].toLocaleString());
-  var line3 = 'Heat: ' + ($scope.info.heat ? 'on' : 'off');
-  svg.append('text')
-      .attr('x', (width / 2))
-      .attr('y', 32)
-      .attr('text-anchor', 'middle')
-      .style('font-size', '12px')
-      .text(line3);
 
 }]);
@@ -0,0 +1,57 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from chart import ReadingWindow, decode_rows, encode_rows
+
+
+class WindowVersionTest(unittest.TestCase):
+  """The version the readings ETag and polls are based on."""
+  def setUp(self):
+    self.window = ReadingWindow.from_rows([(1426940000, 680, 400, 680, 1, False)])
+    self.window.set_latest(False, False, 680, 1426940000000000)
+
+  def test_newer_reading(self):
+    self.window.set_latest(True, False, 680, 1426940300000000)
+    self.assertEqual(self.window.updated, 1426940300000000)
+
+  def test_same_reading_new_set_point(self):
+    self.window.upsert((1426940000, 680, 400, 700, 1, False))
+    self.window.set_latest(False, False, 700, 1426940000000000)
+    self.assertEqual(self.window.set_temp, 700)
+    self.assertGreater(self.window.updated, 1426940000000000)
+
+
+class EncodeRowsTest(unittest.TestCase):
+  """The column payload decodes back to the rows it was made from."""
+  def test_round_trip(self):
+    # Newest first, with set point runs of 3, 1 and 2 and uneven steps
+    rows = [
+      (1426940900, 690, 410, 680, 6, True),
+      (1426940600, 688, 412, 680, 5, True),
+      (1426940300, 684, 415, 680, 4, False),
+      (1426940000, 681, 420, 620, 3, False),
+      (1426939100, 679, 421, 680, 2, False),
+      (1426939099, 679, 421, 680, 1, True),
+    ]
+    payload = encode_rows(rows)
+    self.assertEqual(payload['base'], 1426940900)
+    self.assertEqual(payload['s'], [680, 3, 620, 1, 680, 2])
+    self.assertEqual(decode_rows(payload), [row[:4] for row in rows])
+
+  def test_one_run(self):
+    rows = [(1426940000 - 300 * i, 680, 400, 650, i, False) for i in range(5)]
+    payload = encode_rows(rows)
+    self.assertEqual(payload['s'], [650, 5])
+    self.assertEqual(decode_rows(payload), [row[:4] for row in rows])
+
+  def test_empty(self):
+    payload = encode_rows([])
+    self.assertEqual(payload, {'base': None, 'dt': [], 't': [], 'h': [], 's': []})
+    self.assertEqual(decode_rows(payload), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from overrides import (HOLIDAY, VACATION, apply_overrides, change_due,
+    get_override_index, make_override, prune, to_timestamp)
+
+
+class OverrideExpiryTest(unittest.TestCase):
+  """An ended override on a thermostat without a schedule."""
+  def setUp(self):
+    self.start = datetime(2015, 3, 20, 12)
+    self.end = datetime(2015, 3, 21, 12)
+    self.overrides = [make_override(VACATION, self.start, self.end, 550)]
+
+  def test_applies_until_it_ends(self):
+    now = self.start + timedelta(hours=1)
+    set_temp, next_temp_change = apply_overrides(prune(self.overrides, now), 680, None, now)
+    self.assertEqual(set_temp, 550)
+    self.assertEqual(next_temp_change, self.end)
+
+  def test_nothing_left_after_it_ends(self):
+    now = self.end + timedelta(minutes=1)
+    pruned = prune(self.overrides, now)
+    self.assertEqual(pruned, [])
+    set_temp, next_temp_change = apply_overrides(pruned, 680, None, now)
+    self.assertEqual(set_temp, 680)
+    self.assertIsNone(next_temp_change)
+
+  def test_no_next_change_is_never_due(self):
+    # Comparing None with a datetime used to raise TypeError on every post
+    self.assertFalse(change_due(None, self.end))
+    self.assertFalse(change_due(self.end, self.end))
+    self.assertTrue(change_due(self.end, self.end + timedelta(seconds=1)))
+
+
+class OverrideIndexCacheTest(unittest.TestCase):
+  def test_built_once_per_overrides(self):
+    start = datetime(2015, 3, 20)
+    overrides = [make_override(VACATION, start, start + timedelta(days=7), 550),
+        make_override(HOLIDAY, start + timedelta(days=2), start + timedelta(days=3), 700)]
+    index = get_override_index(overrides)
+    # An equal list, as loaded again from the datastore, reuses the index
+    self.assertIs(get_override_index([dict(o) for o in overrides]), index)
+    self.assertIsNot(get_override_index(overrides[:1]), index)
+    self.assertEqual(index.lookup(to_timestamp(start + timedelta(days=2, hours=1)))['s'], 700)
+
+
+if __name__ == '__main__':
+  unittest.main()
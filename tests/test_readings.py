@@ -0,0 +1,71 @@
+"""Datastore tests, which need the App Engine SDK found with the GAE_SDK
+environment variable and are skipped without it."""
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SDK = os.environ.get('GAE_SDK')
+if SDK:
+  sys.path.insert(0, SDK)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+sys.path.insert(0, ROOT)
+
+T_ID = 'test'
+
+
+@unittest.skipUnless(SDK, 'needs the App Engine SDK, set GAE_SDK')
+class FetchRowsTest(unittest.TestCase):
+  """The projection query rows match rows made from the entities."""
+  def setUp(self):
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+    self.bed = testbed.Testbed()
+    self.bed.activate()
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    self.bed.init_datastore_v3_stub(consistency_policy=policy)
+    self.bed.init_memcache_stub()
+    import chart
+    import main
+    self.chart = chart
+    self.main = main
+    # In the past, so a reading at exactly a day old is outside the last day
+    self.now = datetime.utcnow().replace(microsecond=654321) - timedelta(seconds=1)
+    # Two days of readings, one every ten minutes, and another thermostat's
+    readings = [main.ThermostatData(parent=main.ThermostatData.get_key(T_ID),
+        time=self.now - timedelta(minutes=10 * i), temperature=680 + i % 20,
+        humidity=450 - i % 7, set_temperature=680 if i % 50 else 620, hold=False,
+        heat_on=i % 3 == 0) for i in range(288)]
+    readings.append(main.ThermostatData(parent=main.ThermostatData.get_key('other'),
+        time=self.now, temperature=700, humidity=400, set_temperature=700, hold=False,
+        heat_on=True))
+    main.ndb.put_multi(readings)
+
+  def tearDown(self):
+    self.bed.deactivate()
+
+  def test_oneday_rows(self):
+    ThermostatData = self.main.ThermostatData
+    rows = ThermostatData.fetch_oneday_rows(T_ID)
+    expected = self.chart.reading_rows(ThermostatData.query_oneday_readings(T_ID).fetch())
+    self.assertEqual(len(rows), 144)
+    self.assertEqual(rows, expected)
+
+  def test_range_rows(self):
+    ThermostatData = self.main.ThermostatData
+    start = self.now - timedelta(hours=30)
+    end = self.now - timedelta(hours=20)
+    rows = ThermostatData.fetch_range_rows(T_ID, start, end)
+    readings = ThermostatData.query(ThermostatData.time >= start, ThermostatData.time < end,
+        ancestor=ThermostatData.get_key(T_ID)).order(-ThermostatData.time).fetch()
+    self.assertEqual(len(rows), 60)
+    self.assertEqual(rows, self.chart.reading_rows(readings))
+
+  def test_no_readings(self):
+    self.assertEqual(self.main.ThermostatData.fetch_oneday_rows('none'), [])
+
+
+if __name__ == '__main__':
+  unittest.main()
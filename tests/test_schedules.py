@@ -0,0 +1,87 @@
+import json
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from overrides import preview_transitions
+from schedules import (CHANGE_STEP, CompiledSchedule, ICalProvider, UploadProvider,
+    get_next_event)
+
+
+class SameTimeEntriesTest(unittest.TestCase):
+  """Several schedule entries at the same time, where the last one wins."""
+  def setUp(self):
+    self.schedule = json.dumps([
+      {'dt': 'Sat 14:30 Europe/Berlin', 't': 75},
+      {'dt': 'Sat 14:30 Europe/Berlin', 't': 66},
+    ], separators=(',', ':'))
+    self.now = datetime(2015, 3, 21, 22, 44)
+    self.compiled = CompiledSchedule(self.schedule)
+
+  def test_set_point_matches_next_event(self):
+    set_temp = get_next_event(self.schedule, self.now)[0]
+    self.assertEqual(set_temp, 660)
+    self.assertEqual(self.compiled.set_point_at(self.now), set_temp)
+
+  def test_one_transition_per_instant(self):
+    transitions = self.compiled.transitions(self.now)
+    first = next(transitions)
+    second = next(transitions)
+    self.assertEqual(first[0], datetime(2015, 3, 28, 13, 30))
+    self.assertEqual(first[2], 660)
+    self.assertGreater(second[0], first[0])
+    self.assertEqual(second[0], self.compiled.next_event(first[0] + CHANGE_STEP)[1])
+
+
+class DstWeekTest(unittest.TestCase):
+  """Previews follow the same DST rules as the set points posts apply."""
+  def setUp(self):
+    self.schedule = json.dumps([
+      {'dt': 'Sat 1:00 America/Los_Angeles', 't': 70},
+      {'dt': 'Tue 1:00 America/Los_Angeles', 't': 66},
+      {'dt': 'Wed 23:30 America/Los_Angeles', 't': 75},
+    ], separators=(',', ':'))
+    self.now = datetime(2015, 10, 29, 7)
+    self.compiled = CompiledSchedule(self.schedule)
+
+  def test_set_point_matches_next_event(self):
+    self.assertEqual(self.compiled.next_event(self.now), (660, datetime(2015, 10, 29, 7, 30)))
+    self.assertEqual(self.compiled.set_point_at(self.now), 660)
+
+  def test_preview_matches_next_event(self):
+    changes = preview_transitions(self.compiled, [], self.now, 3)
+    self.assertEqual(changes[0], (datetime(2015, 10, 29, 7, 30), 750))
+    for when, set_temp in changes:
+      self.assertEqual(self.compiled.next_event(when + CHANGE_STEP)[0], set_temp)
+
+
+class InvalidUploadTest(unittest.TestCase):
+  """Malformed uploads fail like any other invalid schedule."""
+  def test_schedule_not_a_list(self):
+    provider = UploadProvider()
+    self.assertIs(provider.get_entries('test', '{"schedule": 5}', 'ET'), False)
+    self.assertIs(provider.get_entries('test', '{"schedule": null}', 'ET'), False)
+
+  def test_end_without_begin(self):
+    content = '\r\n'.join([
+      'BEGIN:VCALENDAR',
+      'END:VEVENT',
+      'BEGIN:VEVENT',
+      'DTSTART:20150323T063000',
+      'SUMMARY:68',
+      'END:VEVENT',
+      'END:VCALENDAR',
+    ])
+    self.assertIs(ICalProvider().get_entries('test', content, 'ET'), False)
+
+  def test_valid_calendar(self):
+    content = 'BEGIN:VEVENT\nDTSTART:20150323T063000\nSUMMARY:68\nEND:VEVENT\n'
+    self.assertEqual(ICalProvider().get_entries('test', content, 'ET'),
+        [{'day': 'Mon', 'time': '06:30', 'temperature': '68'}])
+
+
+if __name__ == '__main__':
+  unittest.main()
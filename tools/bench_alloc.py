@@ -0,0 +1,85 @@
+"""Measure the memory and time cost of dateutil's hot objects.
+
+Prints the size of a relativedelta, a tzstr and a parser result, including
+any per-instance __dict__, then times the parse + astimezone round trip used
+for schedule times and a datetime + relativedelta add. When tracemalloc is
+available the peak memory allocated by a call is printed too. The App
+Engine runtime is Python 2.7, which has no tracemalloc, so there only the
+object sizes and timings are shown.
+
+Usage:
+  python tools/bench_alloc.py [--calls 20000]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dateutil import parser, relativedelta, tz
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+DAY_TIMES = ['Mon 7:00am ET', 'Tuesday 10:30pm PT', 'Sat 12:00am HT', 'Sun 6:15pm ET']
+TZINFOS = {'ET': tz.tzstr('EST+5EDT'), 'PT': tz.tzstr('PST+8PDT'), 'HT': tz.tzstr('HST+10')}
+DEFAULT = datetime(2014, 3, 5)
+UTC = tz.tzutc()
+
+
+def footprint(obj):
+  size = sys.getsizeof(obj)
+  if hasattr(obj, '__dict__'):
+    size += sys.getsizeof(obj.__dict__)
+  return size
+
+def round_trip(day_time):
+  return parser.parse(day_time, tzinfos=TZINFOS, default=DEFAULT).astimezone(UTC)
+
+def add_delta(delta):
+  return DEFAULT + delta
+
+def timed(func, items):
+  start = time.time()
+  for item in items:
+    func(item)
+  return (time.time() - start) / len(items)
+
+def allocations(func, items):
+  """Describe the peak memory allocated while making a call."""
+  if not tracemalloc:
+    return 'no tracemalloc'
+  func(items[0])
+  tracemalloc.start()
+  base = tracemalloc.get_traced_memory()[0]
+  func(items[0])
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return '%d bytes peak' % (peak - base)
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--calls', type=int, default=20000)
+  args = arg_parser.parse_args()
+
+  delta = relativedelta.relativedelta(hours=+2, month=4, day=1, weekday=relativedelta.SU(+1))
+  result = parser.parser()._parse(DAY_TIMES[0])
+  print 'relativedelta %5d bytes' % footprint(delta)
+  print 'tzstr         %5d bytes' % footprint(TZINFOS['ET'])
+  print 'parse result  %5d bytes' % footprint(result)
+
+  day_times = (DAY_TIMES * (args.calls // len(DAY_TIMES) + 1))[:args.calls]
+  deltas = [delta] * args.calls
+  print 'parse + astimezone %8.1f us/call, %s' % (
+      timed(round_trip, day_times) * 1e6, allocations(round_trip, day_times))
+  print 'relativedelta add  %8.1f us/call, %s' % (
+      timed(add_delta, deltas) * 1e6, allocations(add_delta, deltas))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
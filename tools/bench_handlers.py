@@ -0,0 +1,194 @@
+"""Benchmark main.py's handlers and hot functions against the testbed stubs.
+
+Requests go through main.app as webapp2 blank requests, backed by the App
+Engine SDK's in-memory datastore, memcache, task queue and users stubs, after
+loading a thermostat with a schedule and a day of readings. For each case the
+latency percentiles and the API calls per request (counted with an apiproxy
+hook) are printed. The App Engine runtime is Python 2.7, which has no
+tracemalloc, so instead of allocations the net change in gc tracked objects per
+call is shown, which shows growth from caches and leaks. Results can also be
+written as JSON to compare releases.
+
+Needs the App Engine SDK, found with --sdk or the GAE_SDK environment variable.
+
+Usage:
+  python tools/bench_handlers.py --sdk ~/google_appengine [--calls 200] [--json out.json]
+"""
+import argparse
+import collections
+import gc
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+T_ID = 'bench'
+TOKEN = 'benchtok'
+USER_ID = '123'
+SCHEDULE = json.dumps([
+  {'dt': '%s %s ET' % (day, hour), 't': temp}
+  for day in ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+  for hour, temp in [('6:00am', 68), ('9:00am', 62), ('5:00pm', 68), ('10:30pm', 60)]
+], separators=(',', ':'))
+
+
+def setup_sdk(sdk):
+  sys.path.insert(0, sdk)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, ROOT)
+
+def setup_testbed():
+  from google.appengine.datastore import datastore_stub_util
+  from google.appengine.ext import testbed
+
+  bed = testbed.Testbed()
+  bed.activate()
+  bed.setup_env(USER_EMAIL='bench@example.com', USER_ID=USER_ID, USER_IS_ADMIN='0',
+      overwrite=True)
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+  bed.init_datastore_v3_stub(consistency_policy=policy)
+  bed.init_memcache_stub()
+  bed.init_taskqueue_stub(root_path=ROOT)
+  bed.init_urlfetch_stub()
+  bed.init_user_stub()
+  return bed
+
+def load_data(main):
+  now = datetime.utcnow()
+  id_data = main.IdData(parent=main.IdData.get_key(T_ID), user_id=USER_ID, token=TOKEN,
+      schedule=SCHEDULE, timezone='ET', next_temp_change=now + timedelta(days=1))
+  id_data.put()
+  # A day of readings, one every five minutes
+  readings = [main.ThermostatData(parent=main.ThermostatData.get_key(T_ID),
+      time=now - timedelta(minutes=5 * i), temperature=680 + i % 20, humidity=450,
+      set_temperature=680, hold=False, heat_on=i % 3 == 0) for i in range(288)]
+  main.ndb.put_multi(readings)
+  return id_data
+
+def make_cases(main, chart, schedules, id_data):
+  def request(url):
+    return lambda: main.webapp2.Request.blank(url).get_response(main.app)
+
+  def flush_memcache():
+    main.memcache.flush_all()
+
+  def schedule_due():
+    id_data.next_temp_change = datetime.utcnow() - timedelta(minutes=1)
+    id_data.put()
+
+  local_today = datetime(2014, 3, 5)
+  return [
+    # name, setup before each call (not timed), call
+    ('PostData.get', None, request('/post?id=%s&k=%s&t=690&h=450' % (T_ID, TOKEN))),
+    ('PostData.get schedule due', schedule_due,
+        request('/post?id=%s&k=%s&t=690&h=450' % (T_ID, TOKEN))),
+    ('GetHeat.get', None, request('/getheat?id=%s' % T_ID)),
+    ('Thermostat.get', None, request('/?id=%s' % T_ID)),
+    ('Preview.get', None, request('/preview?id=%s&n=10' % T_ID)),
+    ('Readings.get', None, request('/readings?id=%s' % T_ID)),
+    ('Readings.get uncached', flush_memcache, request('/readings?id=%s' % T_ID)),
+    ('Sparkline.get', None, request('/sparkline?id=%s' % T_ID)),
+    # The two ways of loading a day of readings for the chart
+    ('oneday entities', None,
+        lambda: chart.reading_rows(main.ThermostatData.query_oneday_readings(T_ID).fetch())),
+    ('oneday rows', None, lambda: main.ThermostatData.fetch_oneday_rows(T_ID)),
+    ('get_next_event', None, lambda: schedules.get_next_event(SCHEDULE)),
+    ('normalize', None, lambda: schedules.normalize('Wed 5:00pm ET', local_today)),
+    ('add_value_to_average', None, lambda: main.add_value_to_average(683, 690, 3)),
+  ]
+
+
+class RpcCounter(object):
+  """Counts API calls per service and method, with count as an apiproxy pre-call hook."""
+  def __init__(self):
+    self.counts = collections.Counter()
+    self.active = False
+
+  # The SDK reads a hook's arguments with inspect.getargspec, which needs a
+  # function or a method rather than an object with __call__
+  def count(self, service, call, request, response):
+    if self.active:
+      self.counts['%s.%s' % (service, call)] += 1
+
+
+def percentile(values, pct):
+  return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+def run_case(ndb, rpc_counter, setup, call, calls):
+  timings = []
+  objects = 0
+  rpc_counter.counts.clear()
+  for _ in range(calls):
+    if setup:
+      setup()
+    # Each request gets a fresh ndb context in production
+    ndb.get_context().clear_cache()
+    gc.collect()
+    gc.disable()
+    rpc_counter.active = True
+    before = gc.get_count()[0]
+    start = time.time()
+    call()
+    timings.append((time.time() - start) * 1000)
+    objects += gc.get_count()[0] - before
+    rpc_counter.active = False
+    gc.enable()
+  timings.sort()
+  return {
+    'p50_ms': percentile(timings, 50),
+    'p90_ms': percentile(timings, 90),
+    'p99_ms': percentile(timings, 99),
+    'max_ms': timings[-1],
+    'gc_objects_net': float(objects) / calls,
+    'rpcs': dict((name, float(count) / calls) for name, count in rpc_counter.counts.items()),
+  }
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--sdk', default=os.environ.get('GAE_SDK'),
+      help='App Engine SDK directory, defaults to $GAE_SDK')
+  arg_parser.add_argument('--calls', type=int, default=200)
+  arg_parser.add_argument('--json', help='also write the results to this file')
+  args = arg_parser.parse_args()
+  if not args.sdk:
+    arg_parser.error('the App Engine SDK is needed, pass --sdk or set GAE_SDK')
+
+  setup_sdk(args.sdk)
+  bed = setup_testbed()
+  from google.appengine.api import apiproxy_stub_map
+  import chart
+  import main as app_main
+  import schedules
+
+  rpc_counter = RpcCounter()
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('bench_rpcs', rpc_counter.count)
+
+  id_data = load_data(app_main)
+  results = []
+  try:
+    for name, setup, call in make_cases(app_main, chart, schedules, id_data):
+      # One untimed call so lazy imports and caches don't land in the numbers
+      call()
+      result = run_case(app_main.ndb, rpc_counter, setup, call, args.calls)
+      result['name'] = name
+      results.append(result)
+      rpcs = ', '.join('%s %.1f' % item for item in sorted(result['rpcs'].items()))
+      print '%-28s p50 %7.2f  p90 %7.2f  p99 %7.2f ms  %8.1f net objects  %s' % (name,
+          result['p50_ms'], result['p90_ms'], result['p99_ms'], result['gc_objects_net'],
+          rpcs or 'no RPCs')
+  finally:
+    bed.deactivate()
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({'python': sys.version.split()[0], 'calls': args.calls, 'results': results},
+          f, indent=2, sort_keys=True)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
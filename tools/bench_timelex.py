@@ -0,0 +1,89 @@
+"""Check and benchmark the regex tokenizer against dateutil's _timelex.
+
+Random strings built from date-like fragments are split by both tokenizers and
+the token lists compared. A corpus of date strings is then parsed with a
+parser using each tokenizer and the results compared. Timings for both steps
+are printed, and any mismatch makes the script exit with an error.
+
+Usage:
+  python tools/bench_timelex.py [--strings 20000] [--seed 1]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dateutil import parser, tz
+
+FRAGMENTS = [
+  'Mon', 'Tuesday', 'Jan', 'september', 'am', 'p.m.', 'ET', 'UTC', 'GMT+3', 'Z',
+  '7', '07', '2014', '12:30', '10:49:41', '.', '..', ',', '-', '/', ':', ' ', '  ',
+  '\t', '\n', '\x00', '+0300', '3.5', '1.2.3', 'a.b', '1.a', 'a.1', 'x', 'T',
+  '\xe9t\xe9', '\xd7', 'of', 'th', '_',
+]
+
+CORPUS = [
+  'Mon 7:00am ET', 'Tuesday 10:30pm PT', 'Sat 12:00am HT', 'Thu Sep 25 10:36:28 BRST 2003',
+  '2003-09-25T10:49:41.5-03:00', '20030925T104941', '10 h 36', 'Sep 25 2003 10:36',
+  '25.09.2003', '1996.07.10 AD at 15:08:56 PDT', 'Wed, July 10, \'96', '12.0 h',
+  'Thu, 25 Sep 2003 10:49:41 -0300', '10:36:28 PM', '3rd of May 2001', 'Jan 1 1999 11:23:34.578',
+]
+
+
+def random_string(rnd):
+  return ''.join(rnd.choice(FRAGMENTS) for _ in range(rnd.randint(1, 8)))
+
+def parse_or_error(date_parser, timestr):
+  try:
+    result = date_parser.parse(timestr, default=datetime(2014, 1, 1),
+        tzinfos={'ET': tz.tzstr('EST+5EDT'), 'PT': -8 * 3600, 'HT': -10 * 3600})
+  except (ValueError, TypeError):
+    return 'error'
+  return result, result.tzinfo
+
+def timed(func, items):
+  start = time.time()
+  results = [func(item) for item in items]
+  return results, (time.time() - start) / len(items)
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--strings', type=int, default=20000)
+  arg_parser.add_argument('--seed', type=int, default=1)
+  args = arg_parser.parse_args()
+
+  rnd = random.Random(args.seed)
+  strings = [random_string(rnd) for _ in range(args.strings)]
+  failures = 0
+
+  old_tokens, old_time = timed(parser._timelex.split, strings)
+  new_tokens, new_time = timed(parser._retimelex.split, strings)
+  mismatches = [(s, old, new) for s, old, new in zip(strings, old_tokens, new_tokens) if old != new]
+  for s, old, new in mismatches[:20]:
+    print 'MISMATCH splitting %r: _timelex %r, _retimelex %r' % (s, old, new)
+  failures += len(mismatches)
+  print '%d strings split, %d mismatches' % (len(strings), len(mismatches))
+  print '  _timelex   %8.1f us/split' % (old_time * 1e6)
+  print '  _retimelex %8.1f us/split' % (new_time * 1e6)
+
+  corpus = CORPUS * 200
+  old_parser = parser.parser()
+  new_parser = parser.parser(lexer=parser._retimelex)
+  old_results, old_time = timed(lambda s: parse_or_error(old_parser, s), corpus)
+  new_results, new_time = timed(lambda s: parse_or_error(new_parser, s), corpus)
+  mismatches = [(s, old, new) for s, old, new in zip(corpus, old_results, new_results) if old != new]
+  for s, old, new in mismatches[:20]:
+    print 'MISMATCH parsing %r: _timelex %r, _retimelex %r' % (s, old, new)
+  failures += len(mismatches)
+  print '%d strings parsed, %d mismatches' % (len(corpus), len(mismatches))
+  print '  _timelex   %8.1f us/parse' % (old_time * 1e6)
+  print '  _retimelex %8.1f us/parse' % (new_time * 1e6)
+  return 1 if failures else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
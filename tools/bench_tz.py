@@ -0,0 +1,56 @@
+"""Micro-benchmark for the tzstr time zones used by the schedules.
+
+Times utcoffset, dst and tzname for every zone from schedules.get_tzinfos().
+Each zone is timed with the per-year DST transition cache and again with the
+transitions recomputed on every call.
+
+Usage:
+  python tools/bench_tz.py [--calls 20000]
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dateutil import tz
+import schedules
+
+
+class uncachedtzstr(tz.tzstr):
+  """tzstr that finds the DST window for every call, as before the cache."""
+  def _transitions(self, year):
+    yearstart = datetime(year, 1, 1)
+    return yearstart + self._start_delta, yearstart + self._end_delta
+
+
+def time_calls(time_zone, dts):
+  start = time.time()
+  for dt in dts:
+    time_zone.utcoffset(dt)
+    time_zone.dst(dt)
+    time_zone.tzname(dt)
+  return (time.time() - start) / (len(dts) * 3)
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--calls', type=int, default=20000)
+  args = arg_parser.parse_args()
+
+  # Spread over a few days like a schedule's entries, crossing a DST change
+  first = datetime(2014, 3, 5)
+  dts = [first + timedelta(minutes=37 * i) for i in range(args.calls)]
+  dts = [dt.replace(year=2014 + (i % 3)) for i, dt in enumerate(dts)]
+
+  print '%-6s %-28s %10s %10s %8s' % ('abbr', 'rule', 'uncached', 'cached', 'speedup')
+  for name, abbr, rule in schedules.time_zones:
+    cached = time_calls(schedules.get_tzinfos()[abbr], dts)
+    uncached = time_calls(uncachedtzstr(rule), dts)
+    print '%-6s %-28s %8.2fus %8.2fus %7.1fx' % (
+        abbr, rule, uncached * 1e6, cached * 1e6, uncached / cached)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,60 @@
+"""Build the compact zoneinfo bundle shipped in dateutil/zoneinfo.
+
+Every zone listed in zone.tab, plus UTC, is copied from a compiled tz
+database (by default the system's /usr/share/zoneinfo). Only the version 1
+part of each file is kept, since that is all dateutil.tz.tzfile reads, and
+the files are packed into a gzipped tar.
+
+Usage:
+  python tools/build_zoneinfo.py [--zoneinfo /usr/share/zoneinfo]
+"""
+import argparse
+import os
+import struct
+import sys
+import tarfile
+from StringIO import StringIO
+
+BUNDLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'dateutil', 'zoneinfo', 'zoneinfo.tar.gz')
+
+
+def zone_names(zoneinfo):
+  names = set(['UTC'])
+  for line in open(os.path.join(zoneinfo, 'zone.tab')):
+    if line.strip() and not line.startswith('#'):
+      names.add(line.split('\t')[2].strip())
+  return sorted(names)
+
+def version1_data(data):
+  """Return just the version 1 header and data block of a TZif file."""
+  if data[:4] != 'TZif':
+    raise ValueError('magic not found')
+  (ttisgmtcnt, ttisstdcnt, leapcnt,
+   timecnt, typecnt, charcnt) = struct.unpack('>6l', data[20:44])
+  size = (44 + timecnt * 5 + typecnt * 6 + charcnt + leapcnt * 8 +
+          ttisstdcnt + ttisgmtcnt)
+  # Mark it as version 1, as the newer data is dropped
+  return 'TZif\x00' + data[5:size]
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--zoneinfo', default='/usr/share/zoneinfo')
+  arg_parser.add_argument('--output', default=BUNDLE)
+  args = arg_parser.parse_args()
+
+  bundle = tarfile.open(args.output, 'w:gz')
+  names = zone_names(args.zoneinfo)
+  for name in names:
+    data = version1_data(open(os.path.join(args.zoneinfo, name), 'rb').read())
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = 0
+    bundle.addfile(info, StringIO(data))
+  bundle.close()
+  print 'Wrote %d zones to %s (%d bytes)' % (len(names), args.output,
+      os.path.getsize(args.output))
+
+
+if __name__ == '__main__':
+  sys.exit(main())
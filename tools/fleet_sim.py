@@ -0,0 +1,269 @@
+"""Simulate a fleet of thermostats against a local server.
+
+Each simulated house has the two devices from the Arduino sketches:
+- arduino/temp_humidity.ino sends /post?id&k&t&h every minute, adding s and d
+  after a button press, and reads back 'set,hold,heat'.
+- arduino-servo/temp_servo.ino polls /getheat?id every 30 seconds, switches
+  the heater on a '1' and turns it off after 10 minutes without contact.
+
+Requests are plain HTTP/1.0 GETs with 'Connection: close', as the devices
+send them. The room temperature follows a simple model: it loses heat towards
+the outside temperature and gains it while the heater runs, with some sensor
+noise. --time-scale runs the model faster than the wall clock.
+
+The thermostat IDs must be claimed before they accept posts. With --claim,
+the simulator claims '<prefix><n>' through the dev_appserver login cookie and
+reads each token from the page. Otherwise it reads 'id,token' lines from
+--tokens. Throughput, error rate and latency percentiles per endpoint are
+printed at the end and can be written as JSON.
+
+This script uses asyncio, so unlike the other tools it runs on Python 3.
+
+Usage:
+  python3 tools/fleet_sim.py --claim --devices 1000 --duration 300
+  python3 tools/fleet_sim.py --tokens tokens.csv --interval 5 --json out.json
+"""
+import argparse
+import asyncio
+import collections
+import hashlib
+import json
+import random
+import re
+import sys
+import time
+from urllib.parse import quote
+
+# Device behaviour, from the sketches
+POST_INTERVAL = 60
+GETHEAT_INTERVAL = 30
+HEAT_RESET_TIME = 10 * 60
+USER_AGENT = 'ArduinoWiFi/1.1'
+
+TOKEN_RE = re.compile(r'"token":"([A-Za-z0-9]+)"')
+
+
+class Stats(object):
+  """Latencies and outcomes per endpoint."""
+  def __init__(self):
+    self.latencies = collections.defaultdict(list)
+    self.errors = collections.Counter()
+
+  def record(self, endpoint, latency, error=None):
+    self.latencies[endpoint].append(latency)
+    if error:
+      self.errors[(endpoint, error)] += 1
+
+  def summary(self, elapsed):
+    results = {}
+    for endpoint, latencies in sorted(self.latencies.items()):
+      latencies = sorted(latencies)
+      errors = dict((error, count) for (name, error), count in self.errors.items()
+          if name == endpoint)
+      results[endpoint] = {
+        'requests': len(latencies),
+        'per_second': len(latencies) / elapsed,
+        'error_rate': float(sum(errors.values())) / len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p90_ms': percentile(latencies, 90) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+      }
+    return results
+
+
+class House(object):
+  """Room temperature and humidity with a heater switched by the servo."""
+  def __init__(self, rnd):
+    self.rnd = rnd
+    self.temp = rnd.uniform(60, 72)
+    self.humidity = rnd.uniform(30, 55)
+    self.outside = rnd.uniform(20, 55)
+    # Degrees per second: a few hours to cool down, about 20F an hour of heating
+    self.loss = 1.0 / rnd.uniform(2 * 3600, 5 * 3600)
+    self.heat_rate = rnd.uniform(15, 25) / 3600
+    self.heat_on = False
+    self.last_contact = None
+
+  def advance(self, seconds):
+    rate = -self.loss * (self.temp - self.outside)
+    if self.heat_on:
+      rate += self.heat_rate
+    self.temp += rate * seconds
+    self.humidity = min(70, max(20, self.humidity + self.rnd.gauss(0, 0.05) * seconds ** 0.5))
+
+  def reading(self):
+    # The DHT sensor's readings in tenths, as the sketch sends them
+    temp = self.temp + self.rnd.gauss(0, 0.2)
+    return int(temp * 10), int(self.humidity * 10)
+
+
+def percentile(values, pct):
+  return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+async def http_get(host, port, path, timeout):
+  """Send a device style request and return the status and body."""
+  reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+  try:
+    writer.write(('GET %s HTTP/1.0\r\nHost: %s\r\nUser-Agent: %s\r\nConnection: close\r\n\r\n'
+        % (path, host, USER_AGENT)).encode('ascii'))
+    response = await asyncio.wait_for(reader.read(), timeout)
+  finally:
+    writer.close()
+  head, _, body = response.partition(b'\r\n\r\n')
+  status = int(head.split(b' ', 2)[1])
+  return status, body.decode('utf-8', 'replace')
+
+async def request(args, stats, limit, endpoint, path):
+  async with limit:
+    start = time.time()
+    try:
+      status, body = await http_get(args.host, args.port, path, args.timeout)
+    except asyncio.TimeoutError:
+      stats.record(endpoint, time.time() - start, 'timeout')
+      return None
+    except (OSError, ValueError, IndexError) as e:
+      stats.record(endpoint, time.time() - start, type(e).__name__)
+      return None
+  latency = time.time() - start
+  if status != 200:
+    stats.record(endpoint, latency, 'status %d' % status)
+    return None
+  if body.startswith('Error'):
+    stats.record(endpoint, latency, body.strip())
+    return None
+  stats.record(endpoint, latency)
+  return body
+
+async def thermostat(args, stats, limit, house, t_id, token, stop_at):
+  rnd = house.rnd
+  set_temp = None
+  hold = False
+  last = time.time()
+  await asyncio.sleep(rnd.uniform(0, args.interval))
+  while time.time() < stop_at:
+    now = time.time()
+    house.advance((now - last) * args.time_scale)
+    last = now
+    temp, humidity = house.reading()
+    path = '/post?id=%s&k=%s&t=%d&h=%d' % (quote(t_id), quote(token), temp, humidity)
+    if set_temp is not None and rnd.random() < args.button_rate:
+      # Someone pressed a button, so the set point and hold go along
+      set_temp = min(99, max(40, set_temp + rnd.choice([-1, 1])))
+      if rnd.random() < 0.1:
+        hold = not hold
+      path += '&s=%d&d=%s' % (set_temp * 10, 'y' if hold else 'n')
+    body = await request(args, stats, limit, 'post', path)
+    if body is not None:
+      try:
+        set_tenths, hold_flag, _ = body.strip().split(',')
+        set_temp = int(set_tenths) // 10
+        hold = hold_flag == '1'
+      except ValueError:
+        stats.errors[('post', 'bad response')] += 1
+    await asyncio.sleep(args.interval)
+
+async def servo(args, stats, limit, house, t_id, stop_at):
+  await asyncio.sleep(house.rnd.uniform(0, args.servo_interval))
+  while time.time() < stop_at:
+    body = await request(args, stats, limit, 'getheat', '/getheat?id=%s' % quote(t_id))
+    now = time.time()
+    if body is not None and body.strip() in ('0', '1'):
+      house.heat_on = body.strip() == '1'
+      house.last_contact = now
+    elif house.last_contact is None or now - house.last_contact > HEAT_RESET_TIME:
+      house.heat_on = False
+    await asyncio.sleep(args.servo_interval)
+
+async def claim(args, t_id):
+  """Claim an ID on the dev server and return its token."""
+  user_id = str(int(hashlib.md5(args.email.encode('utf-8')).hexdigest()[:10], 16))
+  cookie = 'dev_appserver_login="%s:False:%s"' % (args.email, user_id)
+  for path in ['/?id=%s&claim=y' % quote(t_id), '/?id=%s' % quote(t_id)]:
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    writer.write(('GET %s HTTP/1.0\r\nHost: %s\r\nCookie: %s\r\n\r\n'
+        % (path, args.host, cookie)).encode('ascii'))
+    response = (await reader.read()).decode('utf-8', 'replace')
+    writer.close()
+  match = TOKEN_RE.search(response)
+  if not match:
+    raise RuntimeError('could not claim %s, is it owned by another user?' % t_id)
+  return match.group(1)
+
+async def load_devices(args):
+  if args.tokens:
+    with open(args.tokens) as f:
+      devices = [line.strip().split(',', 1) for line in f if line.strip()]
+    return devices[:args.devices]
+  ids = ['%s%d' % (args.prefix, n) for n in range(args.devices)]
+  limit = asyncio.Semaphore(args.connections)
+  async def claim_one(t_id):
+    async with limit:
+      return t_id, await claim(args, t_id)
+  return await asyncio.gather(*[claim_one(t_id) for t_id in ids])
+
+async def run(args):
+  devices = await load_devices(args)
+  print('Simulating %d houses against %s:%d for %d seconds'
+      % (len(devices), args.host, args.port, args.duration))
+  stats = Stats()
+  limit = asyncio.Semaphore(args.connections)
+  rnd = random.Random(args.seed)
+  start = time.time()
+  stop_at = start + args.duration
+  tasks = []
+  for t_id, token in devices:
+    house = House(random.Random(rnd.random()))
+    tasks.append(thermostat(args, stats, limit, house, t_id, token, stop_at))
+    if not args.no_servo:
+      tasks.append(servo(args, stats, limit, house, t_id, stop_at))
+  await asyncio.gather(*tasks)
+  return stats.summary(time.time() - start)
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--host', default='localhost')
+  arg_parser.add_argument('--port', type=int, default=8080)
+  arg_parser.add_argument('--devices', type=int, default=100, help='number of houses')
+  arg_parser.add_argument('--duration', type=int, default=120, help='seconds to run')
+  arg_parser.add_argument('--interval', type=float, default=POST_INTERVAL,
+      help='seconds between posts')
+  arg_parser.add_argument('--servo-interval', type=float, default=GETHEAT_INTERVAL,
+      help='seconds between heat polls')
+  arg_parser.add_argument('--no-servo', action='store_true', help="don't poll /getheat")
+  arg_parser.add_argument('--time-scale', type=float, default=1.0,
+      help='simulated seconds per second for the house model')
+  arg_parser.add_argument('--button-rate', type=float, default=0.01,
+      help='chance of a button press before each post')
+  arg_parser.add_argument('--connections', type=int, default=200,
+      help='maximum open connections')
+  arg_parser.add_argument('--timeout', type=float, default=10.0,
+      help='seconds to wait for a response, like the sketches')
+  arg_parser.add_argument('--tokens', help="file of 'id,token' lines for claimed IDs")
+  arg_parser.add_argument('--claim', action='store_true',
+      help='claim the IDs on the dev server first')
+  arg_parser.add_argument('--prefix', default='sim', help='prefix for claimed IDs')
+  arg_parser.add_argument('--email', default='fleet@example.com', help='dev server login')
+  arg_parser.add_argument('--seed', type=int, default=1)
+  arg_parser.add_argument('--json', help='also write the results to this file')
+  args = arg_parser.parse_args()
+  if not args.tokens and not args.claim:
+    arg_parser.error('pass --tokens or --claim')
+
+  results = asyncio.run(run(args))
+  for endpoint, result in results.items():
+    print('%-8s %7d requests %8.1f/s  errors %5.2f%%  p50 %7.1f  p90 %7.1f  p99 %7.1f ms'
+        % (endpoint, result['requests'], result['per_second'], result['error_rate'] * 100,
+           result['p50_ms'], result['p90_ms'], result['p99_ms']))
+    for error, count in sorted(result['errors'].items(), key=lambda e: -e[1])[:5]:
+      print('  %6d %s' % (count, error))
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({'devices': args.devices, 'duration': args.duration, 'results': results},
+          f, indent=2, sort_keys=True)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,81 @@
+"""Report the startup cost of the app's modules.
+
+Each module is imported in a fresh interpreter, so the numbers include
+everything it pulls in, as on a new App Engine instance. The work that's
+deferred until first use (loading the parser, building tzinfos and the time
+zone list) is timed as well. Modules that can't be imported, like main without
+the App Engine SDK on the path, are reported as such. Results can also be
+written as JSON to compare releases.
+
+Usage:
+  python tools/import_report.py [--path SDK_DIR ...] [--json report.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MODULES = ['overrides', 'schedules', 'dateutil.parser', 'dateutil.zoneinfo', 'urllib2',
+    'jinja2', 'webapp2', 'main']
+
+DEFERRED = [
+  ('schedules.load_parser', 'schedules.load_parser()'),
+  ('schedules.get_tzinfos', 'schedules.get_tzinfos()'),
+  ('schedules.get_tz_select_array', 'schedules.get_tz_select_array()'),
+]
+
+# Run in the child interpreter, prints the elapsed ms and number of new modules
+TIMER = '''
+import sys, time
+sys.path[:0] = %(path)r
+%(setup)s
+before = len(sys.modules)
+start = time.time()
+%(code)s
+print('%%f %%d' %% ((time.time() - start) * 1000, len(sys.modules) - before))
+'''
+
+
+def measure(path, code, setup=''):
+  child = subprocess.Popen([sys.executable, '-c', TIMER % {'path': path, 'setup': setup, 'code': code}],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=ROOT)
+  out, err = child.communicate()
+  if child.returncode:
+    return {'error': err.strip().splitlines()[-1]}
+  ms, modules = out.split()
+  return {'ms': float(ms), 'modules': int(modules)}
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--path', action='append', default=[],
+      help='extra directory for sys.path, e.g. the App Engine SDK')
+  arg_parser.add_argument('--repeat', type=int, default=3, help='keep the fastest of n runs')
+  arg_parser.add_argument('--json', help='also write the results to this file')
+  args = arg_parser.parse_args()
+
+  path = [ROOT] + [os.path.abspath(p) for p in args.path]
+  cases = [(name, 'import ' + name, '') for name in MODULES]
+  cases += [(name, code, 'import schedules') for name, code in DEFERRED]
+
+  results = []
+  for name, code, setup in cases:
+    runs = [measure(path, code, setup) for _ in range(args.repeat)]
+    result = min(runs, key=lambda r: r.get('ms', 0))
+    result['name'] = name
+    results.append(result)
+    if 'error' in result:
+      print '%-32s %s' % (name, result['error'])
+    else:
+      print '%-32s %8.1f ms %5d modules' % (name, result['ms'], result['modules'])
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump({'python': sys.version.split()[0], 'results': results}, f, indent=2)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,197 @@
+"""Differential fuzzer and benchmark for the schedule engine.
+
+Generates random schedules in every time zone from schedules.time_zones, and
+in a few IANA zones, and runs get_next_event (the reference implementation)
+side by side with CompiledSchedule.next_event over simulated clocks. The clocks are spread over
+several years and cluster around each DST transition. CompiledSchedule.set_point_at
+and the first few transitions, which the previews are built from, are checked
+against the set points and changes get_next_event gives at the same times. The fast path schedule
+time parser is also checked against dateutil's parser, with some malformed
+strings mixed in. Any mismatch is reported and makes the script exit with an
+error. Per-call timings are printed at the end.
+
+Usage:
+  python tools/schedule_fuzz.py [--schedules 2000] [--clocks 20] [--seed 1]
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from dateutil import parser
+import schedules
+
+# IANA zones from the zoneinfo bundle, including southern hemisphere DST
+IANA_ZONES = ['Europe/Berlin', 'Australia/Sydney', 'America/Sao_Paulo', 'Asia/Kolkata']
+
+DAYS = [
+  ('Mon', 'Monday'), ('Tue', 'Tuesday'), ('Wed', 'Wednesday'), ('Thu', 'Thursday'),
+  ('Fri', 'Friday'), ('Sat', 'Saturday'), ('Sun', 'Sunday'),
+]
+
+
+def random_time(rnd):
+  hour = rnd.randint(0, 23)
+  minute = rnd.choice([0, 0, 15, 30, 45, rnd.randint(0, 59)])
+  if rnd.random() < 0.5:
+    return '%d:%02d' % (hour, minute)
+  suffix = 'am' if hour < 12 else 'pm'
+  return '%d:%02d%s' % ((hour % 12) or 12, minute, suffix)
+
+def random_day_time(rnd, abbr):
+  day = rnd.choice(DAYS)[rnd.randint(0, 1)]
+  day_time = '%s %s %s' % (day, random_time(rnd), abbr)
+  if rnd.random() < 0.2:
+    # Vary case and spacing, or break the string so it hits the fallback
+    day_time = rnd.choice([
+      day_time.lower(), day_time.upper(), day_time.replace(' ', '  '),
+      day_time.replace(':', ''), day_time.replace('m ', ' '), day_time + ' x',
+      day_time.replace(abbr, 'UTC'), day_time.replace('1', '3'),
+    ])
+  return day_time
+
+def call_or_error(func, *args):
+  # Compare the time zones too, aware datetimes compare equal across zones
+  try:
+    result = func(*args)
+  except ValueError:
+    return 'ValueError'
+  return result, result.tzinfo
+
+def random_schedule(rnd, abbr):
+  entries = []
+  for _ in range(rnd.randint(1, 12)):
+    day = rnd.choice(DAYS)[rnd.randint(0, 1)]
+    entries.append({'dt': '%s %s %s' % (day, random_time(rnd), abbr), 't': rnd.randint(50, 80)})
+  return json.dumps(entries, separators=(',', ':'))
+
+def dst_transitions(time_zone, years):
+  """Return the UTC instants where the zone's offset changes."""
+  transitions = []
+  for year in years:
+    hour = datetime(year, 1, 1)
+    offset = time_zone.utcoffset(hour)
+    while hour.year == year:
+      hour += timedelta(hours=1)
+      new_offset = time_zone.utcoffset(hour)
+      if new_offset != offset:
+        transitions.append(schedules.local_to_utc(hour, time_zone))
+        offset = new_offset
+  return transitions
+
+def random_clocks(rnd, transitions, years, count):
+  start = datetime(years[0], 1, 1)
+  span = (datetime(years[-1] + 1, 1, 1) - start).total_seconds()
+  clocks = []
+  for _ in range(count):
+    if transitions and rnd.random() < 0.5:
+      # Within a week either side of a DST change, where errors tend to hide
+      clock = rnd.choice(transitions) + timedelta(seconds=rnd.uniform(-7 * 86400, 7 * 86400))
+    else:
+      clock = start + timedelta(seconds=rnd.uniform(0, span))
+    clocks.append(clock.replace(microsecond=0))
+  return clocks
+
+def parse_reference(day_time, default):
+  return parser.parse(day_time, tzinfos=schedules.get_tzinfos(), default=default)
+
+def reference(schedule, now):
+  return schedules.get_next_event(schedule, now)
+
+def optimized(schedule, now):
+  return schedules.get_compiled_schedule(schedule).next_event(now)
+
+def check_transitions(schedule, now, count):
+  """Return a description of the first way transitions disagree with the reference, or None."""
+  compiled = schedules.get_compiled_schedule(schedule)
+  set_temp, next_change = reference(schedule, now)
+  if compiled.set_point_at(now) != set_temp:
+    return 'set_point_at %s, reference %s' % (compiled.set_point_at(now), set_temp)
+  for utc, local, temp in itertools.islice(compiled.transitions(now), count):
+    after = utc + schedules.CHANGE_STEP
+    expected = (next_change, reference(schedule, after)[0])
+    if (utc, temp) != expected:
+      return 'transition %s to %s, reference %s to %s' % (utc, temp, expected[0], expected[1])
+    next_change = reference(schedule, after)[1]
+  return None
+
+def main():
+  arg_parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  arg_parser.add_argument('--schedules', type=int, default=2000)
+  arg_parser.add_argument('--clocks', type=int, default=20, help='clocks per schedule')
+  arg_parser.add_argument('--seed', type=int, default=1)
+  arg_parser.add_argument('--first-year', type=int, default=2014)
+  arg_parser.add_argument('--years', type=int, default=5)
+  arg_parser.add_argument('--transitions', type=int, default=3,
+      help='transitions checked per clock')
+  args = arg_parser.parse_args()
+
+  rnd = random.Random(args.seed)
+  years = range(args.first_year, args.first_year + args.years)
+  zones = [(t[1], schedules.get_tzinfos()[t[1]]) for t in schedules.time_zones]
+  iana_zones = [(name, schedules.get_time_zone(name)) for name in IANA_ZONES]
+  transitions = dict((abbr, dst_transitions(zone, years)) for abbr, zone in zones + iana_zones)
+
+  cases = []
+  for _ in range(args.schedules):
+    abbr = rnd.choice(zones + iana_zones)[0]
+    schedule = random_schedule(rnd, abbr)
+    cases.extend((schedule, clock) for clock in
+        random_clocks(rnd, transitions[abbr], years, args.clocks))
+
+  day_times = []
+  for _ in range(args.schedules * 5):
+    abbr = rnd.choice(zones)[0]
+    default = datetime(2014, 1, 1) + timedelta(days=rnd.randint(0, 365 * args.years),
+        minutes=rnd.choice([0, rnd.randint(0, 1439)]))
+    day_times.append((random_day_time(rnd, abbr), default))
+
+  timings = {}
+  results = {}
+  for name, func in [('parser', parse_reference), ('fast parser', schedules.parse_day_time)]:
+    start = time.time()
+    results[name] = [call_or_error(func, day_time, default) for day_time, default in day_times]
+    timings[name] = (time.time() - start) / len(day_times)
+
+  for name, func in [('reference', reference), ('optimized', optimized)]:
+    start = time.time()
+    results[name] = [func(schedule, clock) for schedule, clock in cases]
+    timings[name] = (time.time() - start) / len(cases)
+
+  start = time.time()
+  transition_mismatches = []
+  for schedule, clock in cases:
+    mismatch = check_transitions(schedule, clock, args.transitions)
+    if mismatch:
+      transition_mismatches.append((schedule, clock, mismatch))
+  timings['transitions'] = (time.time() - start) / len(cases)
+
+  parse_mismatches = [(case, ref, opt) for case, ref, opt in
+      zip(day_times, results['parser'], results['fast parser']) if ref != opt]
+  for (day_time, default), ref, opt in parse_mismatches[:20]:
+    print 'MISMATCH parsing %r with default %s: parser %s, fast parser %s' % (
+        day_time, default, ref, opt)
+  mismatches = [(case, ref, opt) for case, ref, opt in
+      zip(cases, results['reference'], results['optimized']) if ref != opt]
+  for (schedule, clock), ref, opt in mismatches[:20]:
+    print 'MISMATCH at %s for %s: reference %s, optimized %s' % (clock, schedule, ref, opt)
+
+  for schedule, clock, mismatch in transition_mismatches[:20]:
+    print 'MISMATCH in transitions at %s for %s: %s' % (clock, schedule, mismatch)
+
+  print '%d schedule times parsed, %d mismatches' % (len(day_times), len(parse_mismatches))
+  print '%d schedules, %d calls, %d mismatches' % (args.schedules, len(cases), len(mismatches))
+  print '%d transition checks, %d mismatches' % (len(cases), len(transition_mismatches))
+  for name in ['parser', 'fast parser', 'reference', 'optimized', 'transitions']:
+    print '%-12s %8.1f us/call' % (name, timings[name] * 1e6)
+  return 1 if mismatches or parse_mismatches or transition_mismatches else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())